@@ -0,0 +1,395 @@
+from dataclasses import dataclass
+import numpy as np
+from rebalance import JERLookup, _balance_multiplier, default_transverse_resolution
+
+
+def pad_jets(arrays, fill_value=0.):
+    '''
+    Stacks a list of per-event jet arrays into a padded 2D array.
+
+    Returns the padded array of shape (nevents, max_njets) and a
+    boolean mask that is True for real jets.
+    '''
+    njets = np.array([len(x) for x in arrays], dtype=int)
+    width = max(int(njets.max(initial=0)), 1)
+    padded = np.full((len(arrays), width), fill_value, dtype=float)
+    mask = np.arange(width)[None, :] < njets[:, None]
+    if len(arrays):
+        padded[mask] = np.concatenate([np.asarray(x, dtype=float) for x in arrays])
+    return padded, mask
+
+
+class ExponentialPrior():
+    '''
+    Negative log of the exponential HTmiss prior, exp(slope * htmiss).
+
+    Mirrors the RooExponential installed by RebalanceWSFactory._build_gen_htmiss_prior.
+    Calling the prior returns the value and the first two derivatives
+    of -log(prior) with respect to htmiss. The prior is the same for
+    all events, so the per-event keys are ignored.
+    See rebalance.HTMissPriorLookup for the histogram-based prior.
+    '''
+    def __init__(self, slope=-0.05):
+        self.slope = slope
+
+    def event_keys(self, ht):
+        return np.zeros(np.shape(ht), dtype=int)
+
+    def __call__(self, htmiss, keys=None):
+        value = -self.slope * htmiss
+        first = np.full_like(htmiss, -self.slope)
+        second = np.zeros_like(htmiss)
+        return value, first, second
+
+
+@dataclass
+class BatchFitResult():
+    gen_pt: np.ndarray
+    gen_phi: np.ndarray
+    mask: np.ndarray
+    nll_before: np.ndarray
+    nll: np.ndarray
+    edm: np.ndarray
+    niter: np.ndarray
+    status: np.ndarray
+    # Events that took the closed-form path instead of the Newton fit
+    analytic: np.ndarray = None
+
+    @property
+    def gen_px(self):
+        return np.where(self.mask, self.gen_pt * np.cos(self.gen_phi), 0.)
+
+    @property
+    def gen_py(self):
+        return np.where(self.mask, self.gen_pt * np.sin(self.gen_phi), 0.)
+
+    @property
+    def gen_htmiss_pt(self):
+        return np.hypot(self.gen_px.sum(axis=1), self.gen_py.sum(axis=1))
+
+
+def fit_records(result, pt, eta, phi, directions=('pt', 'phi'), tier=-1):
+    '''
+    Per-event records of a BatchFitResult in the layout of fitting.fit_record().
+
+    Events without an analytic solution are skipped. tier marks the records
+    as not fitted with Migrad, see fitting.AdaptiveFitter for the fitted tiers.
+    '''
+    reco = {'pt' : pt, 'phi' : phi, 'px' : pt * np.cos(phi), 'py' : pt * np.sin(phi)}
+    records = []
+    for index in np.nonzero(result.analytic)[0]:
+        mask = result.mask[index]
+        record = {'reco_eta' : eta[index][mask].tolist()}
+        for direction in directions:
+            record[f'reco_{direction}'] = reco[direction][index][mask].tolist()
+        for direction in directions:
+            record[f'gen_{direction}'] = getattr(result, f'gen_{direction}')[index][mask].tolist()
+        record.update(
+            status=int(result.status[index]),
+            edm=float(result.edm[index]),
+            ncalls=0,
+            nll_before=float(result.nll_before[index]),
+            nll=float(result.nll[index]),
+            tier=tier,
+        )
+        records.append(record)
+    return records
+
+
+class BatchRebalancer():
+    '''
+    Vectorized rebalancing fit for many events at once.
+
+    Evaluates the same model as RebalanceWSFactory.build(), i.e. one
+    Gaussian per floating gen momentum times the HTmiss prior,
+    as a negative log likelihood with analytic gradient and Hessian.
+    All events of a chunk are minimized together with a damped Newton method.
+
+    rebalancer = BatchRebalancer()
+    rebalancer.set_jer_source("./input/jer.root", "jer_data")
+    pt, mask = pad_jets(list_of_pt_arrays)
+    ...
+    result = rebalancer.fit(pt, eta, phi, mask)
+    '''
+    # Smoothing scale in GeV for the kink of |HTmiss| at zero
+    _htmiss_epsilon = 1e-3
+    _coordinate_modes = ('pt_phi', 'px_py')
+    # Largest EDM of an accepted closed-form solution, Minuit's criterion for tolerance 1
+    _analytic_edm = 1e-3
+
+    def __init__(self, prior=None, max_iterations=200, tolerance=1e-6, coordinates='pt_phi',
+                 transverse_resolution=default_transverse_resolution):
+        if coordinates not in self._coordinate_modes:
+            raise ValueError(f"Unknown coordinates: '{coordinates}'")
+        self.coordinates = coordinates
+        # Resolution across the jet in units of the pt resolution, as in RebalanceWSFactory
+        self.transverse_resolution = transverse_resolution
+        self._jer_evaluator = None
+        self._prior = prior if prior is not None else ExponentialPrior()
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+
+    def set_jer_source(self, filepath, histogram_name):
+        self._jer_evaluator = JERLookup(filepath, histogram_name)
+
+    def set_jer_evaluator(self, evaluator):
+        self._jer_evaluator = evaluator
+
+    def set_prior(self, prior):
+        self._prior = prior
+
+    def _variable_limits(self, central_value):
+        '''
+        Same limits as RebalanceWSFactory._variable_limits for momentum variables.
+        '''
+        lim = np.maximum(2 * np.abs(central_value), 100)
+        return -lim, lim
+
+    def _resolution(self, pt, eta, mask):
+        '''
+        Relative jet resolution for all real jets, one for padded entries.
+        '''
+        return np.where(mask, self._jer_evaluator.get_jer(pt, eta), 1.)
+
+    def _htmiss(self, x, design):
+        htmiss_xy = np.einsum('nkj,nj->nk', design, x)
+        htmiss = np.sqrt(np.sum(htmiss_xy**2, axis=1) + self._htmiss_epsilon**2)
+        return htmiss_xy, htmiss
+
+    def nll(self, x, reco, sigma, design, mask, prior_keys=0):
+        '''
+        Negative log likelihood per event.
+
+        prior_keys selects the prior per event, see ExponentialPrior.event_keys.
+        '''
+        pull = np.where(mask, (reco - x) / sigma, 0.)
+        _, htmiss = self._htmiss(x, design)
+        prior_value, _, _ = self._prior(htmiss, prior_keys)
+        return 0.5 * np.sum(pull**2, axis=1) + prior_value
+
+    def nll_gradient(self, x, reco, sigma, design, mask, prior_keys=0):
+        '''
+        Negative log likelihood, gradient and Hessian per event.
+        '''
+        weight = np.where(mask, 1. / sigma**2, 0.)
+        pull = np.where(mask, (reco - x) / sigma, 0.)
+        htmiss_xy, htmiss = self._htmiss(x, design)
+        prior_value, prior_first, prior_second = self._prior(htmiss, prior_keys)
+
+        # d|HTmiss| / dx_j
+        direction = htmiss_xy / htmiss[:, None]
+        dhtmiss = np.einsum('nk,nkj->nj', direction, design)
+
+        nll = 0.5 * np.sum(pull**2, axis=1) + prior_value
+        gradient = weight * (x - reco) + prior_first[:, None] * dhtmiss
+
+        projection = np.einsum('nki,nkj->nij', design, design)
+        outer = dhtmiss[:, :, None] * dhtmiss[:, None, :]
+        hessian = prior_second[:, None, None] * outer \
+                + (prior_first / htmiss)[:, None, None] * (projection - outer)
+        pair_mask = mask[:, :, None] & mask[:, None, :]
+        hessian = np.where(pair_mask, hessian, 0.)
+        diagonal = np.arange(x.shape[1])
+        hessian[:, diagonal, diagonal] += np.where(mask, weight, 1.)
+        return nll, gradient, hessian
+
+    def _significance(self, reco, sigma, design, mask):
+        variance = np.where(mask, sigma**2, 0.)
+        htmiss_xy = np.einsum('nkj,nj->nk', design, reco)
+        htmiss = np.hypot(htmiss_xy[:, 0], htmiss_xy[:, 1])
+        matrix = np.einsum('nki,ni,nli->nkl', design, variance, design)
+        # Resolution of HTmiss along its own direction
+        along = np.einsum('nk,nkl,nl->n', htmiss_xy, matrix, htmiss_xy)
+        nonzero = htmiss > 0
+        return np.where(nonzero, htmiss**2 / np.sqrt(np.where(nonzero, along, 1.)), 0.)
+
+    def _balance(self, reco, sigma, design, mask, prior_keys, lower, upper):
+        '''
+        Linearized solution, as RebalanceWSFactory.warm_start_values() for each event, and its EDM.
+        '''
+        variance = np.where(mask, sigma**2, 0.)
+        htmiss_xy = np.einsum('nkj,nj->nk', design, reco)
+        _, strength, _ = self._prior(np.hypot(htmiss_xy[:, 0], htmiss_xy[:, 1]), prior_keys)
+        matrix = np.einsum('nki,ni,nli->nkl', design, variance, design)
+        multiplier = _balance_multiplier(matrix, htmiss_xy, np.maximum(strength, 0.))
+        gen = np.clip(reco - variance * np.einsum('nki,nk->ni', design, multiplier), lower, upper)
+
+        _, gradient, hessian = self.nll_gradient(gen, reco, sigma, design, mask, prior_keys)
+        edm = 0.5 * np.sum(gradient * np.linalg.solve(hessian, gradient[:, :, None])[:, :, 0], axis=1)
+        return gen, edm
+
+    def _analytic(self, args, lower, upper, significance_threshold):
+        '''
+        Closed-form solutions of the events below the significance threshold.
+
+        A solution is only used if its EDM is below _analytic_edm, otherwise the event
+        is fitted. With the exponential prior all solutions pass. With the histogram
+        prior, an accepted solution can be another local minimum than the one
+        the fit finds, so the threshold should stay small.
+        '''
+        reco = args[0]
+        analytic = np.zeros(len(reco), dtype=bool)
+        gen = reco.copy()
+        edm = np.zeros(len(reco))
+        if significance_threshold is None:
+            return analytic, gen, edm
+        candidates = np.nonzero(self._significance(*args[:4]) < significance_threshold)[0]
+        if len(candidates):
+            candidate_gen, candidate_edm = self._balance(*(x[candidates] for x in (*args, lower, upper)))
+            accepted = candidate_edm < self._analytic_edm
+            analytic[candidates[accepted]] = True
+            gen[candidates[accepted]] = candidate_gen[accepted]
+            edm[candidates[accepted]] = candidate_edm[accepted]
+        return analytic, gen, edm
+
+    def _minimize(self, x, reco, sigma, design, mask, prior_keys, lower, upper):
+        nevents, nparams = x.shape
+        niter = np.zeros(nevents, dtype=int)
+        edm = np.full(nevents, np.inf)
+        damping = np.zeros(nevents)
+        active = np.ones(nevents, dtype=bool)
+        identity = np.eye(nparams)
+
+        for _ in range(self.max_iterations):
+            if not active.any():
+                break
+            idx = np.nonzero(active)[0]
+            args = (reco[idx], sigma[idx], design[idx], mask[idx], prior_keys[idx])
+            nll, gradient, hessian = self.nll_gradient(x[idx], *args)
+
+            # Levenberg damping keeps the step a descent direction
+            # for priors with negative curvature
+            system = hessian + damping[idx, None, None] * identity
+            step = -np.linalg.solve(system, gradient[:, :, None])[:, :, 0]
+            slope = np.sum(gradient * step, axis=1)
+            edm[idx] = -0.5 * slope
+            niter[idx] += 1
+
+            # Without enough damping, negative curvature of the prior
+            # can turn the step uphill, these events retry with more damping
+            descent = slope <= 0
+
+            # Converged events still take their last Newton step
+            done = descent & (edm[idx] < self.tolerance)
+            x[idx[done]] = np.clip(x[idx] + step, lower[idx], upper[idx])[done]
+            active[idx[done]] = False
+
+            # Backtracking line search, projected onto the variable limits
+            accepted = done | ~descent
+            alpha = 1.
+            for _ in range(30):
+                if accepted.all():
+                    break
+                trial = np.clip(x[idx] + alpha * step, lower[idx], upper[idx])
+                trial_nll = self.nll(trial, *args)
+                ok = ~accepted & (trial_nll <= nll + 1e-4 * alpha * slope)
+                x[idx[ok]] = trial[ok]
+                accepted |= ok
+                alpha *= 0.5
+            damping[idx] = np.where(accepted & descent, 0.5 * damping[idx], np.maximum(10 * damping[idx], 1e-3))
+
+        status = np.where((edm >= 0) & (edm < self.tolerance), 0, 1)
+        return x, edm, niter, status
+
+    def _model_arrays(self, pt, eta, phi, mask):
+        '''
+        Reco values, resolutions, HTmiss design matrix and mask of the fit parameters.
+
+        For pt/phi coordinates there is one parameter per jet (gen pt).
+        For px/py coordinates there are two per jet, the gen momentum along
+        the reco jet direction for all jets, then the one across it. In this
+        frame the Gaussian of each jet has no correlation term, so the model
+        equals the full 2x2 covariance of (px, py) and does not depend on the
+        orientation of the event.
+        '''
+        sigma_pt = np.where(mask, self._resolution(pt, eta, mask) * pt, 1.)
+        cos, sin = np.cos(phi), np.sin(phi)
+        if self.coordinates == 'pt_phi':
+            reco = np.where(mask, pt, 0.)
+            design = np.stack([cos, sin], axis=1) * mask[:, None, :]
+            return reco, sigma_pt, design, mask
+
+        sigma_across = self.transverse_resolution * sigma_pt
+        reco = np.concatenate([np.where(mask, pt, 0.), np.zeros_like(pt)], axis=1)
+        sigma = np.concatenate([sigma_pt, np.where(mask, sigma_across, 1.)], axis=1)
+        # HTmiss x and y per unit momentum along (cos, sin) and across (-sin, cos) the jet
+        design = np.stack([
+            np.concatenate([cos, -sin], axis=1),
+            np.concatenate([sin, cos], axis=1),
+        ], axis=1) * np.concatenate([mask, mask], axis=1)[:, None, :]
+        return reco, sigma, design, np.concatenate([mask, mask], axis=1)
+
+    def _prepare(self, pt, eta, phi, mask):
+        pt, eta, phi = (np.atleast_2d(np.asarray(x, dtype=float)) for x in (pt, eta, phi))
+        if mask is None:
+            mask = np.ones(pt.shape, dtype=bool)
+        mask = np.asarray(mask, dtype=bool)
+        reco, sigma, design, parameter_mask = self._model_arrays(pt, eta, phi, mask)
+        prior_keys = self._prior.event_keys(np.sum(np.where(mask, pt, 0.), axis=1))
+        return (pt, phi, mask), (reco, sigma, design, parameter_mask, prior_keys)
+
+    def _result(self, jets, args, gen, edm, niter, status, analytic):
+        pt, phi, mask = jets
+        if self.coordinates == 'pt_phi':
+            gen_pt, gen_phi = gen, np.where(mask, phi, 0.)
+        else:
+            njets = pt.shape[1]
+            along, across = gen[:, :njets], gen[:, njets:]
+            cos, sin = np.cos(phi), np.sin(phi)
+            gen_px, gen_py = along * cos - across * sin, along * sin + across * cos
+            gen_pt, gen_phi = np.hypot(gen_px, gen_py), np.where(mask, np.arctan2(gen_py, gen_px), 0.)
+
+        return BatchFitResult(
+            gen_pt=gen_pt,
+            gen_phi=gen_phi,
+            mask=mask,
+            nll_before=self.nll(args[0], *args),
+            nll=self.nll(gen, *args),
+            edm=edm,
+            niter=niter,
+            status=status,
+            analytic=analytic,
+        )
+
+    def significance(self, pt, eta, phi, mask=None):
+        '''
+        Reco HTmiss over its resolution along the HTmiss direction, per event.
+
+        Uses the jet resolutions of the fit model. Events with a small
+        significance are changed very little by the fit.
+        '''
+        _, args = self._prepare(pt, eta, phi, mask)
+        return self._significance(*args[:4])
+
+    def balance(self, pt, eta, phi, mask=None, significance_threshold=np.inf):
+        '''
+        Closed-form solutions only, for the events below significance_threshold.
+
+        Events without an accepted solution keep their reco values with status 1
+        and are marked in the analytic mask of the result, e.g. to send them to the RooFit fit.
+        '''
+        jets, args = self._prepare(pt, eta, phi, mask)
+        analytic, gen, edm = self._analytic(args, *self._variable_limits(args[0]), significance_threshold)
+        status = np.where(analytic, 0, 1)
+        return self._result(jets, args, gen, edm, np.zeros(len(gen), dtype=int), status, analytic)
+
+    def fit(self, pt, eta, phi, mask=None, significance_threshold=None):
+        '''
+        Rebalances all events given as padded (nevents, max_njets) arrays.
+
+        In pt/phi coordinates the gen pt values float and gen phi values
+        are fixed to reco as in the RooFit model. In px/py coordinates
+        both momentum components float.
+        With significance_threshold, events with a smaller reco HTmiss
+        significance take the closed-form solution of balance() instead.
+        '''
+        jets, args = self._prepare(pt, eta, phi, mask)
+        lower, upper = self._variable_limits(args[0])
+        analytic, gen, edm = self._analytic(args, lower, upper, significance_threshold)
+        niter = np.zeros(len(gen), dtype=int)
+        status = np.zeros(len(gen), dtype=int)
+        fitted = ~analytic
+        if fitted.any():
+            selected = (x[fitted] for x in (gen, *args, lower, upper))
+            gen[fitted], edm[fitted], niter[fitted], status[fitted] = self._minimize(*selected)
+        return self._result(jets, args, gen, edm, niter, status, analytic)
@@ -0,0 +1,567 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from jets import JetCollection
+from rebalance import JERLookup, JetFreezePolicy, RebalanceWSCache, RebalanceWSFactory
+from instrument import current_rss_mb
+from batch import BatchRebalancer
+from fitting import fit_record, run_migrad
+from writer import FitResultWriter
+
+
+class SyntheticEventGenerator():
+    '''
+    Generates multi-jet events that are balanced at gen level and smeared with the JER.
+
+    The jet multiplicity is either fixed or drawn from {njets : weight}.
+    Jet pt follows a power law above pt_min, eta is flat within eta_max.
+    The last gen jet recoils against all others, so gen HTmiss is zero.
+
+    generator = SyntheticEventGenerator(JERLookup("./input/jer.root", "jer_data"))
+    jets = generator.generate(njets=5)
+    '''
+    def __init__(self, jer_evaluator, njets=None, pt_min=30., pt_index=4., eta_max=2.5, seed=0):
+        self._jer_evaluator = jer_evaluator
+        self.njets = njets if njets is not None else {n : 1. for n in range(2, 21)}
+        self.pt_min = pt_min
+        self.pt_index = pt_index
+        self.eta_max = eta_max
+        self._rng = np.random.default_rng(seed)
+
+    def _draw_njets(self):
+        if isinstance(self.njets, dict):
+            values = np.array(list(self.njets.keys()))
+            weights = np.array(list(self.njets.values()), dtype=float)
+            return int(self._rng.choice(values, p=weights / weights.sum()))
+        return int(self.njets)
+
+    def generate(self, njets=None):
+        if njets is None:
+            njets = self._draw_njets()
+        u = self._rng.uniform(size=njets - 1)
+        pt = self.pt_min * (1 - u) ** (-1. / (self.pt_index - 1))
+        phi = self._rng.uniform(-np.pi, np.pi, size=njets - 1)
+        recoil_x = -np.sum(pt * np.cos(phi))
+        recoil_y = -np.sum(pt * np.sin(phi))
+        pt = np.append(pt, np.hypot(recoil_x, recoil_y))
+        phi = np.append(phi, np.arctan2(recoil_y, recoil_x))
+        eta = self._rng.uniform(-self.eta_max, self.eta_max, size=njets)
+
+        sigma = self._jer_evaluator.get_jer(pt, eta)
+        reco_pt = np.maximum(pt * (1 + sigma * self._rng.standard_normal(njets)), 1.)
+        return JetCollection(reco_pt, eta, phi)
+
+    def events(self, nevents, njets=None):
+        return [self.generate(njets) for _ in range(nevents)]
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+_import_probe = '''
+import json, resource, sys, time
+start = time.perf_counter()
+for module in sys.argv[2:]:
+    __import__(module)
+from lazyroot import is_loaded, r
+if sys.argv[1] == 'root':
+    r.RooWorkspace
+print(json.dumps({
+    'import_time' : time.perf_counter() - start,
+    'peak_rss_mb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+    'root_loaded' : is_loaded(),
+}))
+'''
+
+# Module sets to compare, the last one forces ROOT and RooFit to load
+_import_scenarios = {
+    'jets' : ('lazy', ['jets']),
+    'batch' : ('lazy', ['batch']),
+    'rebalance' : ('lazy', ['rebalance']),
+    'rebalance+RooFit' : ('root', ['rebalance']),
+}
+
+
+def measure_imports(scenarios=None):
+    '''
+    Import time and peak RSS of fresh interpreters importing the given modules.
+
+    Scenarios in 'lazy' mode fail if the imports loaded ROOT anyway.
+    '''
+    scenarios = scenarios or _import_scenarios
+    results = {}
+    for name, (mode, modules) in scenarios.items():
+        process = subprocess.run(
+            [sys.executable, '-c', _import_probe, mode, *modules],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True
+        )
+        if process.returncode:
+            results[name] = {'error' : process.stderr.strip().splitlines()[-1]}
+        else:
+            results[name] = json.loads(process.stdout)
+            if mode == 'lazy' and results[name]['root_loaded']:
+                results[name]['error'] = f"importing {', '.join(modules)} loaded ROOT"
+    return results
+
+
+def run_benchmark(njets_values=range(2, 21), nevents=50, jer_source=("./input/jer.root", "jer_data"),
+                  likelihood='product', coordinates='pt_phi', seed=0):
+    '''
+    Times build, minimize and write separately for each jet multiplicity.
+    '''
+    jer_evaluator = JERLookup(*jer_source)
+    generator = SyntheticEventGenerator(jer_evaluator, seed=seed)
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for njets in njets_values:
+            timings = {'build' : 0., 'minimize' : 0., 'write' : 0.}
+            ncalls, failed = [], 0
+            writer = FitResultWriter(os.path.join(tmpdir, f"bench_{njets}.root"))
+            for jets in generator.events(nevents, njets):
+                start = time.perf_counter()
+                factory = RebalanceWSFactory(jets, likelihood=likelihood, coordinates=coordinates)
+                factory.set_jer_evaluator(jer_evaluator)
+                factory.build()
+                built = time.perf_counter()
+                result = run_migrad(factory)
+                minimized = time.perf_counter()
+                writer.fill(**fit_record(factory, result))
+                timings['build'] += built - start
+                timings['minimize'] += minimized - built
+                timings['write'] += time.perf_counter() - minimized
+                ncalls.append(result.ncalls)
+                failed += result.status != 0
+            start = time.perf_counter()
+            writer.close()
+            timings['write'] += time.perf_counter() - start
+
+            results.append({
+                'njets' : njets,
+                'nevents' : nevents,
+                **{f'{stage}_time_per_event' : value / nevents for stage, value in timings.items()},
+                'mean_ncalls' : float(np.mean(ncalls)),
+                'failed_fits' : int(failed),
+                'rss_mb' : current_rss_mb(),
+                # ru_maxrss is in kB on Linux, and covers build and minimize
+                'peak_rss_mb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+            })
+    return {
+        'revision' : _revision(),
+        'config' : {
+            'nevents' : nevents,
+            'likelihood' : likelihood,
+            'coordinates' : coordinates,
+            'seed' : seed,
+        },
+        'results' : results,
+    }
+
+
+def _fit_variants(jets, jer_evaluator, variants, **factory_kwargs):
+    '''
+    Builds and fits the same event once per set of extra factory arguments.
+    '''
+    fits = {}
+    for mode, kwargs in variants.items():
+        factory = RebalanceWSFactory(jets, **factory_kwargs, **kwargs)
+        factory.set_jer_evaluator(jer_evaluator)
+        factory.build()
+        start = time.perf_counter()
+        result = run_migrad(factory)
+        fits[mode] = {
+            'fit_time' : time.perf_counter() - start,
+            'ncalls' : result.ncalls,
+            'nll' : result.nll,
+            'status' : result.status,
+            'htmiss' : factory.extract().gen_htmiss,
+            'nfloating' : len(factory.floating_momenta()),
+        }
+    return fits
+
+
+def run_warm_start_comparison(njets_values=range(2, 21), nevents=50, jer_source=("./input/jer.root", "jer_data"),
+                              likelihood='product', coordinates='pt_phi', seed=0):
+    '''
+    Fits every event starting from reco and from the warm start.
+
+    Reports the function calls per fit in both cases and the difference of the final NLL.
+    '''
+    jer_evaluator = JERLookup(*jer_source)
+    generator = SyntheticEventGenerator(jer_evaluator, seed=seed)
+    variants = {'reco' : {}, 'warm' : {'warm_start' : True}}
+    results = []
+    for njets in njets_values:
+        ncalls = {'reco' : [], 'warm' : []}
+        fit_time = {'reco' : 0., 'warm' : 0.}
+        nll_differences, failed = [], 0
+        for jets in generator.events(nevents, njets):
+            fits = _fit_variants(jets, jer_evaluator, variants, likelihood=likelihood, coordinates=coordinates)
+            for mode, fit in fits.items():
+                ncalls[mode].append(fit['ncalls'])
+                fit_time[mode] += fit['fit_time']
+            nll_differences.append(fits['warm']['nll'] - fits['reco']['nll'])
+            failed += fits['warm']['status'] != 0
+        mean_ncalls = {mode : float(np.mean(values)) for mode, values in ncalls.items()}
+        results.append({
+            'njets' : njets,
+            'nevents' : nevents,
+            'reco_mean_ncalls' : mean_ncalls['reco'],
+            'warm_mean_ncalls' : mean_ncalls['warm'],
+            'ncalls_reduction' : 1 - mean_ncalls['warm'] / mean_ncalls['reco'] if mean_ncalls['reco'] else 0.,
+            'reco_fit_time_per_event' : fit_time['reco'] / nevents,
+            'warm_fit_time_per_event' : fit_time['warm'] / nevents,
+            'nll_difference_max' : float(np.max(np.abs(nll_differences))),
+            'warm_failed_fits' : int(failed),
+        })
+    return {
+        'revision' : _revision(),
+        'config' : {
+            'nevents' : nevents,
+            'likelihood' : likelihood,
+            'coordinates' : coordinates,
+            'seed' : seed,
+        },
+        'results' : results,
+    }
+
+
+def run_freeze_comparison(freeze_policy, njets_values=range(2, 21), nevents=50,
+                          jer_source=("./input/jer.root", "jer_data"), likelihood='product', coordinates='pt_phi', seed=0):
+    '''
+    Fits every event with and without the freeze policy.
+
+    Reports the fit time saved and the shift of the rebalanced gen HTmiss
+    with respect to the full fit, for each jet multiplicity.
+    '''
+    jer_evaluator = JERLookup(*jer_source)
+    generator = SyntheticEventGenerator(jer_evaluator, seed=seed)
+    variants = {'full' : {}, 'frozen' : {'freeze_policy' : freeze_policy}}
+    results = []
+    for njets in njets_values:
+        fit_time = {'full' : 0., 'frozen' : 0.}
+        nfloating, shifts = [], []
+        for jets in generator.events(nevents, njets):
+            fits = _fit_variants(jets, jer_evaluator, variants, likelihood=likelihood, coordinates=coordinates)
+            for mode, fit in fits.items():
+                fit_time[mode] += fit['fit_time']
+            nfloating.append(fits['frozen']['nfloating'])
+            shifts.append(fits['frozen']['htmiss'] - fits['full']['htmiss'])
+        shifts = np.array(shifts)
+        results.append({
+            'njets' : njets,
+            'nevents' : nevents,
+            'mean_floating' : float(np.mean(nfloating)),
+            'full_fit_time_per_event' : fit_time['full'] / nevents,
+            'frozen_fit_time_per_event' : fit_time['frozen'] / nevents,
+            'fit_time_saving' : 1 - fit_time['frozen'] / fit_time['full'] if fit_time['full'] else 0.,
+            'htmiss_shift_mean' : float(np.mean(shifts)),
+            'htmiss_shift_rms' : float(np.sqrt(np.mean(shifts**2))),
+            'htmiss_shift_max' : float(np.max(np.abs(shifts))),
+        })
+    return {
+        'revision' : _revision(),
+        'config' : {
+            'nevents' : nevents,
+            'likelihood' : likelihood,
+            'coordinates' : coordinates,
+            'seed' : seed,
+            'freeze_pt_min' : freeze_policy.pt_min,
+            'freeze_max_floating' : freeze_policy.max_floating,
+        },
+        'results' : results,
+    }
+
+
+def check_rotation_invariance(nevents=20, njets=4, angles=(0., 0.5, np.pi / 4, 2., -2.5),
+                              jer_source=("./input/jer.root", "jer_data"), coordinates=('pt_phi', 'px_py'),
+                              roofit=False, seed=0):
+    '''
+    Fits every event rotated by several azimuthal angles.
+
+    The likelihood only depends on relative angles, so gen HTmiss and the
+    final NLL must not change under the rotation. Reports the largest spread
+    over the angles per coordinate mode, for the batch fit and with roofit=True
+    also for the RooFit model.
+    '''
+    jer_evaluator = JERLookup(*jer_source)
+    generator = SyntheticEventGenerator(jer_evaluator, seed=seed)
+    events = generator.events(nevents, njets)
+    results = []
+    for mode in coordinates:
+        rebalancer = BatchRebalancer(coordinates=mode)
+        rebalancer.set_jer_evaluator(jer_evaluator)
+        htmiss, nll = [], []
+        for angle in angles:
+            pt = np.array([jets.pt for jets in events])
+            eta = np.array([jets.eta for jets in events])
+            phi = np.array([np.angle(np.exp(1j * (jets.phi + angle))) for jets in events])
+            result = rebalancer.fit(pt, eta, phi)
+            htmiss.append(result.gen_htmiss_pt)
+            nll.append(result.nll)
+        rows = {'batch' : (np.array(htmiss), np.array(nll))}
+        if roofit:
+            htmiss, nll = [], []
+            for angle in angles:
+                fits = [_fit_variants(JetCollection(jets.pt, jets.eta, jets.phi + angle), jer_evaluator,
+                                      {mode : {}}, coordinates=mode)[mode] for jets in events]
+                htmiss.append([fit['htmiss'] for fit in fits])
+                nll.append([fit['nll'] for fit in fits])
+            rows['roofit'] = (np.array(htmiss), np.array(nll))
+        for engine, (htmiss, nll) in rows.items():
+            results.append({
+                'coordinates' : mode,
+                'engine' : engine,
+                'htmiss_spread_max' : float(np.max(np.ptp(htmiss, axis=0))),
+                'nll_spread_max' : float(np.max(np.ptp(nll, axis=0))),
+            })
+    return {
+        'revision' : _revision(),
+        'config' : {'nevents' : nevents, 'njets' : njets, 'angles' : list(angles), 'seed' : seed},
+        'results' : results,
+    }
+
+
+def compare_batch_to_roofit(njets_values=range(2, 9), nevents=20, jer_source=("./input/jer.root", "jer_data"),
+                            htmiss_prior_source=("./input/htmiss_prior.root", 2017), coordinates=('pt_phi', 'px_py'),
+                            gen_tolerance=0.1, nll_tolerance=1e-2, seed=0):
+    '''
+    Fits the same events with batch.BatchRebalancer and with Migrad on the workspace.
+
+    Both engines minimize the same unnormalized NLL, the workspace is built
+    with likelihood='sum' so that the values can be compared directly.
+    For each coordinate mode and prior, reports the largest difference of the
+    gen px and py in units of the jet pt resolution and of the final NLL.
+    A configuration passes if they stay within gen_tolerance and nll_tolerance,
+    which allow for the EDM of Migrad's default tolerance of 1e-3.
+    '''
+    from batch import ExponentialPrior
+    from rebalance import HTMissPriorLookup
+    jer_evaluator = JERLookup(*jer_source)
+    priors = {'exponential' : ExponentialPrior()}
+    if htmiss_prior_source is not None:
+        priors['histogram'] = HTMissPriorLookup(*htmiss_prior_source)
+    generator = SyntheticEventGenerator(jer_evaluator, seed=seed)
+    events = [jets for njets in njets_values for jets in generator.events(nevents, njets)]
+    results = []
+    for mode in coordinates:
+        for prior_name, prior in priors.items():
+            rebalancer = BatchRebalancer(prior=prior, coordinates=mode)
+            rebalancer.set_jer_evaluator(jer_evaluator)
+            gen_difference, nll_difference, failed = [], [], 0
+            for jets in events:
+                batch = rebalancer.fit(jets.pt[None, :], jets.eta[None, :], jets.phi[None, :])
+                factory = RebalanceWSFactory(jets, likelihood='sum', coordinates=mode, prior=prior_name)
+                factory.set_jer_evaluator(jer_evaluator)
+                if prior_name == 'histogram':
+                    factory.set_htmiss_prior(prior)
+                factory.build()
+                result = run_migrad(factory)
+                values = factory.extract()
+                factory.close()
+                failed += (result.status != 0) + int(batch.status[0] != 0)
+                sigma = jer_evaluator.get_jer(jets.pt, jets.eta) * jets.pt
+                difference = np.hypot(values.gen_px - batch.gen_px[0], values.gen_py - batch.gen_py[0]) / sigma
+                gen_difference.append(float(np.max(difference)))
+                nll_difference.append(abs(result.nll - float(batch.nll[0])))
+            results.append({
+                'coordinates' : mode,
+                'prior' : prior_name,
+                'nevents' : len(events),
+                'gen_difference_max' : max(gen_difference),
+                'nll_difference_max' : max(nll_difference),
+                'failed_fits' : failed,
+                'passed' : max(gen_difference) <= gen_tolerance and max(nll_difference) <= nll_tolerance,
+            })
+    return {
+        'revision' : _revision(),
+        'config' : {
+            'njets' : list(njets_values),
+            'nevents' : nevents,
+            'gen_tolerance' : gen_tolerance,
+            'nll_tolerance' : nll_tolerance,
+            'seed' : seed,
+        },
+        'results' : results,
+    }
+
+
+def run_soak(nevents=100000, sample_interval=1000, jer_source=("./input/jer.root", "jer_data"),
+             max_rss_mb=None, seed=0, **factory_kwargs):
+    '''
+    Fits a long stream of events with mixed jet multiplicities through the workspace cache.
+
+    Samples the resident memory every sample_interval events. The growth over
+    the second half of the run, in MB per 10^4 events, should be compatible with zero.
+    '''
+    jer_evaluator = JERLookup(*jer_source)
+    generator = SyntheticEventGenerator(jer_evaluator, seed=seed)
+    cache = RebalanceWSCache(jer_source=jer_source, max_rss_mb=max_rss_mb, **factory_kwargs)
+    samples = []
+    start = time.perf_counter()
+    for event in range(nevents):
+        run_migrad(cache.get(generator.generate()))
+        if event % sample_interval == 0 or event == nevents - 1:
+            samples.append((event, current_rss_mb()))
+    cache.clear()
+
+    events, rss = (np.array(x, dtype=float) for x in zip(*samples))
+    late = events >= events[-1] / 2
+    growth = np.polyfit(events[late], rss[late], 1)[0] * 1e4 if late.sum() > 1 else 0.
+    return {
+        'revision' : _revision(),
+        'nevents' : nevents,
+        'wall_time' : time.perf_counter() - start,
+        'rss_start_mb' : float(rss[0]),
+        'rss_end_mb' : float(rss[-1]),
+        'rss_max_mb' : float(rss.max()),
+        'rss_growth_mb_per_1e4_events' : float(growth),
+        'cache_cleanups' : cache.cleanups,
+        'samples' : samples,
+    }
+
+
+def compare(baseline, candidate):
+    '''
+    Ratios candidate / baseline of the per-event timings and the peak RSS difference for each jet multiplicity.
+    '''
+    baseline = {x['njets'] : x for x in baseline['results']}
+    lines = []
+    for row in candidate['results']:
+        reference = baseline.get(row['njets'])
+        if reference is None:
+            continue
+        ratios = []
+        for stage in ('build', 'minimize', 'write'):
+            key = f'{stage}_time_per_event'
+            ratio = row[key] / reference[key] if reference[key] else float('nan')
+            ratios.append(f"{stage} x{ratio:.2f}")
+        if 'peak_rss_mb' in row and 'peak_rss_mb' in reference:
+            ratios.append(f"peak RSS {row['peak_rss_mb'] - reference['peak_rss_mb']:+.0f} MB")
+        lines.append(f"njets={row['njets']:2d}: " + ', '.join(ratios))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark workspace building, fitting and writing.")
+    parser.add_argument('--nevents', type=int, default=50)
+    parser.add_argument('--njets-min', type=int, default=2)
+    parser.add_argument('--njets-max', type=int, default=20)
+    parser.add_argument('--likelihood', default='product')
+    parser.add_argument('--coordinates', default='pt_phi')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CANDIDATE'))
+    parser.add_argument('--soak', type=int, default=None, metavar='NEVENTS',
+                        help="Check that memory stays flat over a long run")
+    parser.add_argument('--max-rss-mb', type=float, default=None)
+    parser.add_argument('--warm-start', action='store_true', help="Compare fits from reco and from the warm start")
+    parser.add_argument('--imports', action='store_true', help="Measure import time and memory with and without ROOT")
+    parser.add_argument('--batch-vs-roofit', action='store_true',
+                        help="Check that the batch fit reproduces the RooFit gen values and NLL")
+    parser.add_argument('--rotation', action='store_true', help="Check that fits do not depend on the event orientation")
+    parser.add_argument('--roofit', action='store_true', help="Include the RooFit model in the rotation check")
+    parser.add_argument('--freeze-pt-min', type=float, default=None,
+                        help="Compare against fits with jets below this pt frozen")
+    parser.add_argument('--freeze-max-floating', type=int, default=None,
+                        help="Compare against fits with only this many leading jets floating")
+    args = parser.parse_args()
+
+    if args.compare:
+        baseline, candidate = (json.load(open(x)) for x in args.compare)
+        print(compare(baseline, candidate))
+        return
+
+    if args.imports:
+        for name, result in measure_imports().items():
+            if 'error' in result:
+                print(f"{name:20s} failed: {result['error']}")
+            else:
+                print(f"{name:20s} {1000 * result['import_time']:8.0f} ms {result['peak_rss_mb']:8.0f} MB ROOT={result['root_loaded']}")
+        return
+
+    if args.batch_vs_roofit:
+        result = compare_batch_to_roofit(njets_values=range(args.njets_min, args.njets_max + 1), nevents=args.nevents)
+        for row in result['results']:
+            print(f"{row['coordinates']:7s} {row['prior']:12s}: max |gen diff| {row['gen_difference_max']:.2g} sigma, "
+                  f"max |dNLL| {row['nll_difference_max']:.2g}, {row['failed_fits']} failed fits, "
+                  f"{'ok' if row['passed'] else 'FAILED'}")
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        if not all(row['passed'] for row in result['results']):
+            sys.exit(1)
+        return
+
+    if args.rotation:
+        result = check_rotation_invariance(nevents=args.nevents, njets=args.njets_min, roofit=args.roofit)
+        for row in result['results']:
+            print(f"{row['coordinates']:7s} {row['engine']:7s}: HTmiss spread {row['htmiss_spread_max']:.2g} GeV, "
+                  f"NLL spread {row['nll_spread_max']:.2g}")
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        return
+
+    if args.soak:
+        result = run_soak(args.soak, max_rss_mb=args.max_rss_mb, likelihood=args.likelihood, coordinates=args.coordinates)
+        print(f"RSS {result['rss_start_mb']:.0f} -> {result['rss_end_mb']:.0f} MB (max {result['rss_max_mb']:.0f}), "
+              f"growth {result['rss_growth_mb_per_1e4_events']:.2f} MB per 10^4 events, {result['cache_cleanups']} cleanups")
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        return
+
+    if args.warm_start:
+        result = run_warm_start_comparison(
+            njets_values=range(args.njets_min, args.njets_max + 1),
+            nevents=args.nevents,
+            likelihood=args.likelihood,
+            coordinates=args.coordinates
+        )
+        for row in result['results']:
+            print(f"njets={row['njets']:2d}: calls {row['reco_mean_ncalls']:.1f} -> {row['warm_mean_ncalls']:.1f} "
+                  f"(-{100 * row['ncalls_reduction']:.0f}%), max |dNLL| {row['nll_difference_max']:.2g}")
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        return
+
+    if args.freeze_pt_min is not None or args.freeze_max_floating is not None:
+        result = run_freeze_comparison(
+            JetFreezePolicy(pt_min=args.freeze_pt_min, max_floating=args.freeze_max_floating),
+            njets_values=range(args.njets_min, args.njets_max + 1),
+            nevents=args.nevents,
+            likelihood=args.likelihood,
+            coordinates=args.coordinates
+        )
+        for row in result['results']:
+            print(f"njets={row['njets']:2d}: {row['mean_floating']:.1f} floating, "
+                  f"fit time -{100 * row['fit_time_saving']:.0f}%, "
+                  f"HTmiss shift rms {row['htmiss_shift_rms']:.2f} GeV")
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        return
+
+    result = run_benchmark(
+        njets_values=range(args.njets_min, args.njets_max + 1),
+        nevents=args.nevents,
+        likelihood=args.likelihood,
+        coordinates=args.coordinates
+    )
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+import hashlib
+import json
+import sqlite3
+import numpy as np
+from jets import JetCollection
+from tables import htmiss_prior_table_name, is_table_directory, table_metadata, table_path
+
+# Fit result fields stored next to the gen momenta, as in fitting.FitResult
+_result_fields = ('status', 'edm', 'ncalls', 'nll_before', 'nll', 'tier')
+
+_coordinate_directions = {
+    'pt_phi' : ('pt', 'phi'),
+    'px_py' : ('px', 'py'),
+}
+
+
+def _file_digest(filepath):
+    h = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _source_digest(filepath, table_name):
+    # Exported tables carry the digest of their ROOT file, so both give the same configuration
+    if is_table_directory(filepath):
+        return table_metadata(table_path(filepath, table_name))['digest']
+    return _file_digest(filepath)
+
+
+def fit_configuration(jer_source, coordinates='pt_phi', likelihood='product', prior='exponential',
+                      htmiss_prior_source=None, **extra):
+    '''
+    Everything besides the jets that changes the fit result, for FitResultCache.
+
+    Input files enter with a digest of their content, so that
+    replacing a file with the same name invalidates the cache.
+    Tables exported from a file count as that file.
+    '''
+    jer_file, jer_histogram = jer_source
+    configuration = {
+        'jer_file' : _source_digest(jer_file, jer_histogram),
+        'jer_histogram' : jer_histogram,
+        'coordinates' : coordinates,
+        'likelihood' : likelihood,
+        'prior' : prior,
+        **extra,
+    }
+    if prior == 'histogram':
+        prior_file, year = htmiss_prior_source
+        configuration['htmiss_prior_file'] = _source_digest(prior_file, htmiss_prior_table_name(year))
+        configuration['htmiss_prior_year'] = year
+    return configuration
+
+
+class FitResultCache():
+    '''
+    On-disk cache of fit results, keyed by the input jets and the fit configuration.
+
+    The key is a hash of the reco jet kinematics and of the configuration
+    from fit_configuration(), so events that did not change between two runs
+    are not fitted again. Entries hold the fitted gen momenta and the fit
+    status in the layout of fitting.fit_record(). Once more than max_entries
+    are stored, the least recently used entries are evicted.
+
+    cache = FitResultCache("fits.sqlite", fit_configuration(("./input/jer.root", "jer_data")))
+    record = cache.get(jets)
+    if record is None:
+        record = fit_record(factory, run_migrad(factory))
+        cache.put(jets, record)
+    cache.close()
+    '''
+    # Number of insertions between checks of the cache size
+    _evict_interval = 1000
+
+    def __init__(self, filepath, configuration, max_entries=10000000):
+        self.filepath = filepath
+        self.configuration = configuration
+        self.max_entries = max_entries
+        self.directions = _coordinate_directions[configuration.get('coordinates', 'pt_phi')]
+        self._prefix = hashlib.sha1(json.dumps(configuration, sort_keys=True).encode()).digest()
+        self._connection = sqlite3.connect(filepath, timeout=60.)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS fits ('
+            'key BLOB PRIMARY KEY, gen BLOB, status INTEGER, edm REAL, ncalls INTEGER, '
+            'nll_before REAL, nll REAL, last_used INTEGER, tier INTEGER DEFAULT 0)'
+        )
+        # Caches written before the fit tier was stored
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info(fits)')]
+        if 'tier' not in columns:
+            self._connection.execute('ALTER TABLE fits ADD COLUMN tier INTEGER DEFAULT 0')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS fits_last_used ON fits (last_used)')
+        self._clock = self._connection.execute('SELECT COALESCE(MAX(last_used), 0) FROM fits').fetchone()[0]
+        self._touched = {}
+        self._inserted = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, jets):
+        jets = JetCollection.from_jets(jets)
+        values = np.stack([jets.pt, jets.eta, jets.phi], axis=1)
+        return hashlib.blake2b(self._prefix + values.tobytes(), digest_size=16).digest()
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def _record(self, jets, row):
+        jets = JetCollection.from_jets(jets)
+        gen, *result = row
+        gen = np.frombuffer(gen, dtype=np.float64).reshape(len(self.directions), len(jets))
+        record = {'reco_eta' : jets.eta.tolist()}
+        for direction in self.directions:
+            record[f'reco_{direction}'] = jets.momentum(direction).tolist()
+        for direction, values in zip(self.directions, gen):
+            record[f'gen_{direction}'] = values.tolist()
+        record.update(zip(_result_fields, result))
+        return record
+
+    def get(self, jets):
+        '''
+        The cached record for the jets, or None if they have not been fitted with this configuration.
+        '''
+        key = self.key(jets)
+        row = self._connection.execute(
+            f"SELECT gen, {', '.join(_result_fields)} FROM fits WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touched[key] = self._tick()
+        return self._record(jets, row)
+
+    def get_many(self, events, chunk_size=500):
+        '''
+        Cached records for many events at once, None for events that are not cached.
+        '''
+        keys = [self.key(jets) for jets in events]
+        rows = {}
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start:start+chunk_size]
+            query = f"SELECT key, gen, {', '.join(_result_fields)} FROM fits WHERE key IN ({','.join('?' * len(chunk))})"
+            for key, *row in self._connection.execute(query, chunk):
+                rows[key] = row
+        records = []
+        for key, jets in zip(keys, events):
+            row = rows.get(key)
+            if row is None:
+                self.misses += 1
+                records.append(None)
+            else:
+                self.hits += 1
+                self._touched[key] = self._tick()
+                records.append(self._record(jets, row))
+        return records
+
+    def _row(self, jets, record):
+        gen = np.array([record[f'gen_{direction}'] for direction in self.directions], dtype=np.float64)
+        return (self.key(jets), gen.tobytes(), *(record.get(x, 0) for x in _result_fields), self._tick())
+
+    def _insert(self, rows):
+        self._connection.executemany(
+            f"INSERT OR REPLACE INTO fits (key, gen, {', '.join(_result_fields)}, last_used) "
+            f"VALUES ({', '.join('?' * (len(_result_fields) + 3))})",
+            rows
+        )
+
+    def put(self, jets, record):
+        '''
+        Stores a fitting.fit_record() dictionary for the jets.
+        '''
+        self._insert([self._row(jets, record)])
+        self._inserted += 1
+        if self._inserted % self._evict_interval == 0:
+            self.commit()
+            self.evict()
+
+    def put_many(self, events, records):
+        '''
+        Stores the records of many events and commits right away, together with the access times of hits.
+
+        Used by processes that share one cache file, so that the write lock
+        is only held for one short transaction per call.
+        '''
+        rows = [self._row(jets, record) for jets, record in zip(events, records)]
+        if rows:
+            self._insert(rows)
+        self.commit()
+        inserted, self._inserted = self._inserted, self._inserted + len(rows)
+        if inserted // self._evict_interval != self._inserted // self._evict_interval:
+            self.evict()
+
+    def evict(self):
+        '''
+        Removes the least recently used entries beyond max_entries.
+        '''
+        size = len(self)
+        if size <= self.max_entries:
+            return 0
+        excess = size - self.max_entries
+        self._connection.execute(
+            'DELETE FROM fits WHERE key IN (SELECT key FROM fits ORDER BY last_used LIMIT ?)', (excess,)
+        )
+        self._connection.commit()
+        return excess
+
+    def commit(self):
+        # Access times of hits are only written here, so lookups stay read-only
+        if self._touched:
+            self._connection.executemany(
+                'UPDATE fits SET last_used = ? WHERE key = ?',
+                [(used, key) for key, used in self._touched.items()]
+            )
+            self._touched.clear()
+        self._connection.commit()
+
+    def close(self):
+        if self._connection is None:
+            return
+        self.commit()
+        self.evict()
+        self._connection.close()
+        self._connection = None
+
+    def __len__(self):
+        return self._connection.execute('SELECT COUNT(*) FROM fits').fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,142 +1,78 @@
-import numpy as np
-from numpy.lib.function_base import extract
-import ROOT as r
-r.gSystem.Load('libRooFit')
-from rebalance import Jet, RebalanceWSFactory
-import uproot
-from matplotlib import pyplot as plt
+import argparse
+from itertools import islice
+from lazyroot import r
+from rebalance import RebalanceWSCache
+from reader import JetReader
+from cache import FitResultCache, fit_configuration
+from fitting import fit_record, run_migrad
+from writer import FitResultWriter
+from plotting import PlotSampler
+from instrument import Instrumentation
+
+
+def read_jets(filepath="tree_22.root", step_size=10000):
+    '''
+    Yields a jets.JetCollection for each event, reading the input in chunks.
+    '''
+    return JetReader(filepath, step_size=step_size).events()
+
+
+def main(debug_workspaces=False, fit_cache_path=None, plot_sample='random', plot_fraction=1., instrumentation_path=None):
+    jer_source = ("./input/jer.root","jer_data")
+    # Stage timings and fit statistics, written periodically and at the end
+    instrumentation = Instrumentation(export_path=instrumentation_path) if instrumentation_path else None
+    cache = RebalanceWSCache(jer_source=jer_source, instrumentation=instrumentation)
+    # Events fitted in an earlier run with the same configuration are not fitted again
+    fit_cache = FitResultCache(fit_cache_path, fit_configuration(jer_source)) if fit_cache_path else None
+    # Full workspaces are only persisted for debugging
+    debug_file = r.TFile("./output/workspaces.root","RECREATE") if debug_workspaces else None
+    # Plots are rendered in a separate process pool from the fit records
+    plots = PlotSampler("./output", sample=plot_sample, fraction=plot_fraction)
+    try:
+        _run_events(cache, fit_cache, debug_file, plots)
+    finally:
+        if debug_file:
+            debug_file.Close()
+        if fit_cache is not None:
+            fit_cache.close()
+        cache.clear()
+        if instrumentation is not None:
+            instrumentation.dump()
+            print(instrumentation.report())
+
+
+def _run_events(cache, fit_cache, debug_file, plots):
+    with FitResultWriter("./output/rebalanced.root") as writer, plots:
+        for event, jets in enumerate(islice(read_jets(), 10)):
+            record = fit_cache.get(jets) if fit_cache is not None else None
+            if record is not None:
+                writer.fill(entry=event, **record)
+                plots.add(event, record)
+                continue
+            rbwsfac = cache.get(jets)
+            ws = rbwsfac.get_ws()
+
+            if debug_file:
+                ws.Print("v")
+                ws.Write(f'ws_{event}_before')
+            result = run_migrad(rbwsfac)
+            if debug_file:
+                ws.Write(f'ws_{event}_after')
+
+            record = fit_record(rbwsfac, result)
+            if fit_cache is not None:
+                fit_cache.put(jets, record)
+            writer.fill(entry=event, **record)
+            plots.add(event, record)
 
 
-def read_jets(event):
-    f = uproot.open("tree_22.root")
-    t = f['Events']
-    n = event
-    
-    pt, phi, eta = (t[f'Jet_{x}'].array(entrystart=n, entrystop=n+1)[0] for x in ['pt','phi','eta'])
-    
-    return [Jet(ipt, iphi, ieta) for ipt, iphi, ieta in zip(pt, phi, eta)]
-
-
-def extract_values(ws, tier):
-    x, y = [], []
-    htx, hty = [], []
-
-    for i in range(int(ws.var("njets").getValV())):
-        x.append(ws.var(f"{tier}_px_{i}").getValV())
-        y.append(ws.var(f"{tier}_py_{i}").getValV())
-
-    htx = -np.sum(x)
-    hty = -np.sum(y)
-
-    return x, y, htx, hty
-
-def extract_values_pt_phi(ws, tier):
-    pt,phi = [], []
-    htx, hty = [], []
-
-    for i in range(int(ws.var("njets").getValV())):
-        pt.append(ws.var(f"{tier}_pt_{i}").getValV())
-        phi.append(ws.var(f"{tier}_phi_{i}").getValV())
-
-    pt = np.array(pt)
-    phi = np.array(phi)
-    x = pt * np.cos(phi)
-    y = pt * np.sin(phi)
-    htx = -np.sum(x)
-    hty = -np.sum(y)
-
-
-    return x, y, htx, hty
-
-def plot_plane(ws, tag):
-    plt.gcf().clf()
-    fig = plt.gcf()
-    ax = plt.gca()
-    
-    # Reco
-    reco_x, reco_y, reco_htx, reco_hty = extract_values_pt_phi(ws, "reco")
-    gen_x, gen_y, gen_htx, gen_hty = extract_values_pt_phi(ws, "gen")
-
-
-
-    for i in range(len(reco_x)):
-        ax.arrow(
-                x=0,
-                y=0,
-                dx=reco_x[i],
-                dy=reco_y[i],
-                head_width=10,
-                color='navy',
-                label='Reco jet' if i==0 else None
-                )
-        ax.arrow(   
-                 x=0,
-                 y=0,
-                 dx=gen_x[i],
-                 dy=gen_y[i],
-                 head_width=10,
-                 color='crimson',
-                 label='Gen jet' if i==0 else None
-                 )
-    
-    reco_ht = np.hypot(reco_htx, reco_hty)
-    gen_ht = np.hypot(gen_htx, gen_hty)
-    ax.arrow(
-             x=0,
-             y=0,
-             dx=reco_htx,
-             dy=reco_hty,
-             head_width=10,
-             color='navy',
-             width=10,
-             alpha=0.5,
-            #  fill=False,
-             label=f'Reco $H_{{T}}^{{miss}}$ ({reco_ht:.0f} GeV)')
-    ax.arrow(
-             x=0,
-             y=0,
-             dx=gen_htx,
-             dy=gen_hty,
-             head_width=10,
-             color='crimson',
-             width=10,
-             alpha=0.5,
-            #  fill=False,
-             label=f'Gen $H_{{T}}^{{miss}}$ ({gen_ht:.0f} GeV)')
-
-
-    axis_maximum = 1.2*max([abs(x) for x in (reco_x + reco_y + [reco_ht])])
-    ax.set_ylim(-axis_maximum, axis_maximum)
-    ax.set_xlim(-axis_maximum, axis_maximum)
-    ax.set_title(f"{tag}, NLL = {ws.function('nll').getValV():.2f}")
-    ax.legend()
-    fig.savefig(f"output/test_{tag}.png", dpi=300)
-
-
-def main():
-
-    for event in range(10):
-        jets = read_jets(event)
-        rbwsfac = RebalanceWSFactory(jets)
-        rbwsfac.set_jer_source("./input/jer.root","jer_data")
-        rbwsfac.build()
-        ws = rbwsfac.get_ws()
-        ws.Print("v")
-
-        # for i in range(int(ws.var("njets").getValV())):
-        #     print(i, jets[i].px, ws.var(f"gen_px_{i}").getValV(), ws.var(f"reco_px_{i}").getValV())
-        
-        # for i in range(int(ws.var("njets").getValV())):
-        #     print(i, jets[i].py, ws.var(f"gen_py_{i}").getValV(), ws.var(f"reco_py_{i}").getValV())
-
-
-        f=r.TFile(f"./output/ws_{event}.root","RECREATE")
-        plot_plane(ws, tag=f"{event}_before")
-        ws.Write('before')
-        m = r.RooMinimizer(ws.function("nll"))
-        m.migrad()
-        ws.Write('after')
-        plot_plane(ws, tag=f"{event}_after")
-    return ws
 if __name__ == "__main__":
-    ws = main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Rebalance the first events of tree_22.root.")
+    parser.add_argument('--debug-workspaces', action='store_true', help="Write the workspaces before and after each fit")
+    parser.add_argument('--fit-cache', default=None, help="Reuse fit results stored in this SQLite file")
+    parser.add_argument('--plot-sample', choices=('random', 'worst_nll'), default='random')
+    parser.add_argument('--plot-fraction', type=float, default=1.)
+    parser.add_argument('--instrumentation', default=None, help="Write stage timings and fit statistics to this JSON file")
+    args = parser.parse_args()
+    main(debug_workspaces=args.debug_workspaces, fit_cache_path=args.fit_cache, plot_sample=args.plot_sample,
+         plot_fraction=args.plot_fraction, instrumentation_path=args.instrumentation)
\ No newline at end of file
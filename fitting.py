@@ -0,0 +1,420 @@
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+import time
+import numpy as np
+from lazyroot import r
+from batch import BatchRebalancer, ExponentialPrior, pad_jets
+from kernels import get_kernel
+
+
+@dataclass
+class FitResult():
+    status: int
+    edm: float
+    ncalls: int
+    nll_before: float
+    nll: float
+    tier: int = 0
+
+
+@dataclass
+class FitTier():
+    '''
+    Settings of one attempt of AdaptiveFitter.
+
+    start is 'current' to continue from the gen values as they are,
+    'reco' to restart from the reco momenta, or 'warm' to restart
+    from the closed-form warm start of the factory.
+    '''
+    strategy: int = 0
+    tolerance: float = 1.
+    start: str = 'current'
+    hesse: bool = False
+
+
+default_tiers = (
+    FitTier(strategy=0, tolerance=1.),
+    FitTier(strategy=1, tolerance=1., start='warm'),
+    FitTier(strategy=2, tolerance=0.1, start='reco', hesse=True),
+)
+
+
+def run_migrad(factory, print_level=-1):
+    '''
+    Minimizes the workspace NLL with the default RooMinimizer.migrad().
+    '''
+    nll = factory.get_ws().function(factory._name_negative_log_likelihood())
+    nll_before = nll.getVal()
+    start = time.perf_counter()
+    minimizer = factory.get_minimizer()
+    minimizer.setPrintLevel(print_level)
+    minimizer.migrad()
+    result = minimizer.fitter().Result()
+    fit_result = FitResult(
+        status=result.Status(),
+        edm=result.Edm(),
+        ncalls=result.NCalls(),
+        nll_before=nll_before,
+        nll=nll.getVal(),
+    )
+    _record_fit(factory, fit_result, time.perf_counter() - start)
+    return fit_result
+
+
+def _record_fit(factory, result, fit_time):
+    instrumentation = factory.get_instrumentation()
+    if instrumentation is None:
+        return
+    instrumentation.record('fit_time', fit_time)
+    instrumentation.record('fit_ncalls', result.ncalls)
+    instrumentation.record('fit_tier', result.tier)
+
+
+class AdaptiveFitter():
+    '''
+    Minimizes the workspace NLL with a cheap Migrad setting first and escalates only when needed.
+
+    The tiers are tried in order until one converges, i.e. Migrad (and Hesse,
+    if requested by the tier) returns status 0 and the EDM is below max_edm.
+    All tiers of an event share a budget of max_calls NLL evaluations
+    and timeout seconds. The time budget is checked between tiers and turned
+    into a call limit for the next tier, using the time per call so far. For
+    the first tier, the time per call is estimated from one NLL evaluation.
+    If no tier converges, the parameters of the tier with the lowest NLL are kept.
+    The returned FitResult holds the index of that tier.
+
+    fitter = AdaptiveFitter(factory, max_calls=5000, timeout=1.)
+    result = fitter.fit()
+    '''
+    _starts = ('current', 'reco', 'warm')
+
+    def __init__(self, factory, tiers=default_tiers, max_edm=1e-3, max_calls=None, timeout=None, print_level=-1):
+        for tier in tiers:
+            if tier.start not in self._starts:
+                raise ValueError(f"Unknown start point: '{tier.start}'")
+        self.factory = factory
+        self.tiers = tiers
+        self.max_edm = max_edm
+        self.max_calls = max_calls
+        self.timeout = timeout
+        self.print_level = print_level
+
+    def _gen_vars(self):
+        ws = self.factory.get_ws()
+        return [ws.var(self.factory._name_gen_momentum_var(direction, index)) for direction, index in self.factory.floating_momenta()]
+
+    def _set_start(self, start):
+        factory = self.factory
+        if start == 'warm':
+            factory._seed_gen_momenta()
+        elif start == 'reco':
+            ws = factory.get_ws()
+            for direction, index in factory.floating_momenta():
+                gen_var = ws.var(factory._name_gen_momentum_var(direction, index))
+                gen_var.setVal(ws.var(factory._name_reco_momentum_var(direction, index)).getVal())
+
+    def _call_budget(self, ncalls, elapsed, call_time):
+        '''
+        Calls left for the next tier, None if unlimited.
+
+        call_time is the estimated time per call before any tier has run.
+        '''
+        budget = None
+        if self.max_calls is not None:
+            budget = self.max_calls - ncalls
+        if self.timeout is not None:
+            time_per_call = elapsed / ncalls if ncalls else call_time
+            calls = int((self.timeout - elapsed) / time_per_call)
+            budget = calls if budget is None else min(budget, calls)
+        return budget
+
+    def _call_time(self, nll, gen_vars):
+        '''
+        Time of one NLL evaluation, the estimated cost of a Migrad call.
+        '''
+        # Setting a value marks the NLL dirty, so it is recomputed and not read from the cache
+        gen_vars[0].setVal(gen_vars[0].getVal())
+        start = time.perf_counter()
+        nll.getVal()
+        return max(time.perf_counter() - start, 1e-7)
+
+    def _configure(self, minimizer, tier, budget):
+        minimizer.setStrategy(tier.strategy)
+        minimizer.setEps(tier.tolerance)
+        # RooMinimizer's own default limit
+        calls = 500 * len(self.factory.floating_momenta()) if budget is None else budget
+        minimizer.setMaxFunctionCalls(calls)
+        minimizer.setMaxIterations(calls)
+
+    def fit(self):
+        factory = self.factory
+        nll = factory.get_ws().function(factory._name_negative_log_likelihood())
+        nll_before = nll.getVal()
+        gen_vars = self._gen_vars()
+        if not gen_vars:
+            return FitResult(status=0, edm=0., ncalls=0, nll_before=nll_before, nll=nll_before)
+
+        minimizer = factory.get_minimizer()
+        minimizer.setPrintLevel(self.print_level)
+        start = time.perf_counter()
+        call_time = self._call_time(nll, gen_vars) if self.timeout is not None else None
+        ncalls = 0
+        best = None
+        for index, tier in enumerate(self.tiers):
+            elapsed = time.perf_counter() - start
+            budget = self._call_budget(ncalls, elapsed, call_time)
+            if index > 0 and (budget is not None and budget <= 0 or self.timeout is not None and elapsed >= self.timeout):
+                break
+            if budget is not None:
+                # The first tier always runs, a limit of zero would mean Minuit's default
+                budget = max(budget, 1)
+            self._set_start(tier.start)
+            self._configure(minimizer, tier, budget)
+            status = minimizer.migrad()
+            if tier.hesse and status == 0:
+                status = minimizer.hesse()
+            result = minimizer.fitter().Result()
+            ncalls += result.NCalls()
+            converged = status == 0 and 0 <= result.Edm() < self.max_edm
+            value = nll.getVal()
+            if best is None or converged or value < best[0].nll:
+                best = (FitResult(status=status, edm=result.Edm(), ncalls=0, nll_before=nll_before, nll=value, tier=index),
+                        [var.getVal() for var in gen_vars])
+            if converged:
+                break
+
+        fit_result, values = best
+        for var, value in zip(gen_vars, values):
+            var.setVal(value)
+        fit_result.ncalls = ncalls
+        _record_fit(factory, fit_result, time.perf_counter() - start)
+        return fit_result
+
+
+def fit_record(factory, result):
+    '''
+    Flat per-event record of reco and fitted gen kinematics plus the fit result, e.g. for FitResultWriter.
+    '''
+    values = factory.extract()
+    record = {'reco_eta' : factory.jets.eta.tolist()}
+    for tier in ('reco', 'gen'):
+        for direction in factory._directions:
+            record[f'{tier}_{direction}'] = getattr(values, f'{tier}_{direction}').tolist()
+    record.update(asdict(result))
+    return record
+
+
+class FitValueAccumulator():
+    '''
+    Stacks the rebalance.WorkspaceValues and fit results of many events into arrays.
+
+    Adding an event only appends the arrays of factory.extract(), there are no
+    lookups of workspace variables. arrays() returns padded (nevents, max_njets)
+    per-jet arrays, one value per event for everything else, and the jet mask,
+    as taken by FitResultWriter.fill_arrays(). Extra per-jet or per-event
+    values can be passed by name. All events need the same fields.
+
+    accumulator = FitValueAccumulator()
+    accumulator.add(factory.extract(), run_migrad(factory), reco_eta=factory.jets.eta, entry=event)
+    writer.fill_arrays(**accumulator.arrays())
+    '''
+    _jet_fields = ('reco_pt', 'reco_phi', 'reco_px', 'reco_py', 'gen_pt', 'gen_phi', 'gen_px', 'gen_py')
+    _event_fields = ('reco_htmiss', 'gen_htmiss', 'nll')
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._jets = defaultdict(list)
+        self._events = defaultdict(list)
+
+    def add(self, values, result=None, **extra):
+        event = {name : getattr(values, name) for name in self._event_fields}
+        if result is not None:
+            event.update(asdict(result))
+        for name in self._jet_fields:
+            self._jets[name].append(getattr(values, name))
+        for name, value in extra.items():
+            if np.ndim(value) > 0:
+                self._jets[name].append(value)
+            else:
+                event[name] = value
+        for name, value in event.items():
+            self._events[name].append(value)
+
+    def __len__(self):
+        return len(self._jets['reco_pt'])
+
+    def arrays(self):
+        _, mask = pad_jets(self._jets['reco_pt'])
+        columns = {name : pad_jets(values)[0] for name, values in self._jets.items()}
+        for name, values in self._events.items():
+            columns[name] = np.asarray(values)
+        columns['mask'] = mask
+        return columns
+
+
+class GradientFitter():
+    '''
+    Minimizes the NLL of a built RebalanceWSFactory with Minuit2 and analytic gradients.
+
+    The NLL and its gradient with respect to the floating gen momenta are
+    evaluated with the same vectorized model as batch.BatchRebalancer,
+    so Minuit does not need finite differences through formula expressions.
+    For factories built with likelihood='compiled', the compiled kernel
+    of the workspace is used instead.
+    The fitted values are written back into the workspace.
+
+    fitter = GradientFitter(factory)
+    result = fitter.fit()
+    '''
+    def __init__(self, factory, strategy=1, tolerance=1., max_calls=0, print_level=-1):
+        self.factory = factory
+        self.strategy = strategy
+        self.tolerance = tolerance
+        self.max_calls = max_calls
+        self.print_level = print_level
+        self._last_x = None
+        self._last_gradient = None
+
+    def _prior(self):
+        if self.factory.prior == 'histogram':
+            return self.factory.get_htmiss_prior()
+        ws = self.factory.get_ws()
+        slope = ws.var(self.factory._name_total_gen_htmiss_prior_slope()).getVal()
+        return ExponentialPrior(slope)
+
+    def _init_model(self):
+        factory = self.factory
+        ws = factory.get_ws()
+        # Frozen momenta stay in the model for HTmiss, but are fixed in Minuit
+        self._parameters = factory.modelled_momenta()
+        self._gen_vars = [ws.var(factory._name_gen_momentum_var(direction, index)) for direction, index in self._parameters]
+        reco = [ws.var(factory._name_reco_momentum_var(direction, index)).getVal() for direction, index in self._parameters]
+        design = [factory._htmiss_derivative(direction, index) for direction, index in self._parameters]
+        self._rotation = self._parameter_rotation()
+        resolution_directions = factory._resolution_directions[factory.coordinates]
+        sigma = [ws.var(factory._name_jet_resolution_var(resolution_directions[i % len(resolution_directions)], index)).getVal()
+                 for i, (_, index) in enumerate(self._parameters)]
+
+        # The batch model floats the rotated parameters, i.e. along and across the jets in px/py
+        self._reco = (self._rotation @ np.array(reco))[None, :]
+        self._sigma = np.array(sigma)[None, :]
+        self._design = (np.array(design, dtype=float).reshape(-1, 2).T @ self._rotation.T)[None, :, :]
+        self._mask = np.ones(self._reco.shape, dtype=bool)
+        self._fixed = [var.isConstant() for var in self._gen_vars]
+        prior = self._prior()
+        self._prior_keys = prior.event_keys(np.array([np.sum(factory.jets.pt)]))
+        self._model = BatchRebalancer(prior=prior)
+        self._last_x = None
+        self._kernel = None
+        if factory.likelihood == 'compiled':
+            self._init_kernel()
+
+    def _parameter_rotation(self):
+        '''
+        Rotation from the fit parameters into the frame of the reco jet directions.
+
+        The Gaussians of the px/py model are uncorrelated along and across the
+        reco jet, for pt/phi the parameters are used as they are.
+        '''
+        rotation = np.eye(len(self._parameters))
+        if self.factory.coordinates != 'px_py':
+            return rotation
+        for i in range(0, len(self._parameters), 2):
+            phi = self.factory.jets.phi[self._parameters[i][1]]
+            rotation[i:i+2, i:i+2] = [[np.cos(phi), np.sin(phi)], [-np.sin(phi), np.cos(phi)]]
+        return rotation
+
+    def _init_kernel(self):
+        self._kernel = get_kernel(self.factory.njets, self.factory.coordinates)
+        arguments = self.factory.kernel_arguments()
+        names = [x.GetName() for x in arguments]
+        self._kernel_x = np.array([x.getVal() for x in arguments])
+        self._kernel_index = np.array([names.index(var.GetName()) for var in self._gen_vars], dtype=int)
+
+    def _kernel_arguments(self, x):
+        kernel_x = self._kernel_x.copy()
+        kernel_x[self._kernel_index] = x[0]
+        return kernel_x
+
+    def _args(self):
+        return (self._reco, self._sigma, self._design, self._mask, self._prior_keys)
+
+    def _to_array(self, x):
+        return np.array([x[i] for i in range(len(self._parameters))])[None, :]
+
+    def _value(self, x):
+        x = self._to_array(x)
+        if self._kernel is not None:
+            return float(self._kernel.nll(self._kernel_arguments(x)))
+        return float(self._model.nll(x @ self._rotation.T, *self._args())[0])
+
+    def _full_gradient(self, x):
+        if self._kernel is not None:
+            return self._kernel.gradient(self._kernel_arguments(x))[self._kernel_index]
+        _, gradient, _ = self._model.nll_gradient(x @ self._rotation.T, *self._args())
+        return gradient[0] @ self._rotation
+
+    def _gradient(self, x, coordinate):
+        # Minuit asks for one component at a time, the full gradient is computed once per point
+        x = self._to_array(x)
+        if self._last_x is None or not np.array_equal(x, self._last_x):
+            self._last_gradient = self._full_gradient(x)
+            self._last_x = x
+        return float(self._last_gradient[coordinate])
+
+    def _create_minimizer(self):
+        minimizer = r.Math.Factory.CreateMinimizer("Minuit2", "Migrad")
+        minimizer.SetStrategy(self.strategy)
+        minimizer.SetTolerance(self.tolerance)
+        minimizer.SetErrorDef(0.5)
+        minimizer.SetPrintLevel(self.print_level)
+        if self.max_calls:
+            minimizer.SetMaxFunctionCalls(self.max_calls)
+        return minimizer
+
+    def fit(self):
+        self._init_model()
+        nparams = len(self._parameters)
+        start = self._to_array([var.getVal() for var in self._gen_vars])
+        nll_before = float(self._model.nll(start @ self._rotation.T, *self._args())[0])
+        if all(self._fixed):
+            return FitResult(status=0, edm=0., ncalls=0, nll_before=nll_before, nll=nll_before)
+
+        self._functor = r.Math.GradFunctor(self._value, self._gradient, nparams)
+        minimizer = self._create_minimizer()
+        minimizer.SetFunction(self._functor)
+        for i, var in enumerate(self._gen_vars):
+            if self._fixed[i]:
+                minimizer.SetFixedVariable(i, var.GetName(), var.getVal())
+                continue
+            minimizer.SetLimitedVariable(
+                i,
+                var.GetName(),
+                var.getVal(),
+                self._sigma[0, i],
+                var.getMin(),
+                var.getMax()
+            )
+        start = time.perf_counter()
+        minimizer.Minimize()
+        fit_time = time.perf_counter() - start
+
+        values = minimizer.X()
+        errors = minimizer.Errors()
+        for i, var in enumerate(self._gen_vars):
+            if self._fixed[i]:
+                continue
+            var.setVal(values[i])
+            var.setError(errors[i])
+
+        result = FitResult(
+            status=minimizer.Status(),
+            edm=minimizer.Edm(),
+            ncalls=minimizer.NCalls(),
+            nll_before=nll_before,
+            nll=minimizer.MinValue(),
+        )
+        _record_fit(self.factory, result, fit_time)
+        return result
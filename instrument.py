@@ -0,0 +1,161 @@
+import json
+import os
+import resource
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+import numpy as np
+
+
+def current_rss_mb():
+    '''
+    Resident set size of this process right now, unlike ru_maxrss which is the peak.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1024.**2
+    except (OSError, ValueError):
+        # ru_maxrss is in kB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class StreamingHistogram():
+    '''
+    Fixed log-binned histogram with running moments, so memory does not grow with the number of events.
+    '''
+    edges = np.logspace(-7, 7, 141)
+
+    def __init__(self):
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        self.entries = 0
+        self.total = 0.
+        self.minimum = np.inf
+        self.maximum = -np.inf
+
+    def fill(self, value):
+        self.counts[np.searchsorted(self.edges, value)] += 1
+        self.entries += 1
+        self.total += value
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+
+    def merge(self, other):
+        '''
+        Adds the entries of another histogram, e.g. one filled in a worker process.
+        '''
+        self.counts += other.counts
+        self.entries += other.entries
+        self.total += other.total
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    @property
+    def mean(self):
+        return self.total / self.entries if self.entries else 0.
+
+    def quantile(self, q):
+        '''
+        Approximate quantile, the upper edge of the bin containing it.
+        '''
+        if not self.entries:
+            return 0.
+        index = int(np.searchsorted(np.cumsum(self.counts), q * self.entries))
+        edge = self.edges[min(index, len(self.edges) - 1)]
+        return float(np.clip(edge, self.minimum, self.maximum))
+
+    def summary(self):
+        return {
+            'entries' : self.entries,
+            'mean' : self.mean,
+            'min' : self.minimum,
+            'max' : self.maximum,
+            'p50' : self.quantile(0.5),
+            'p90' : self.quantile(0.9),
+            'p99' : self.quantile(0.99),
+        }
+
+    def to_dict(self):
+        return {
+            **self.summary(),
+            'edges' : self.edges.tolist(),
+            'counts' : self.counts.tolist(),
+        }
+
+
+class Instrumentation():
+    '''
+    Collects wall time and workspace object counts per build stage, plus fit statistics.
+
+    Values are aggregated into histograms across events. If export_path is set,
+    the histograms are written as JSON every export_interval seconds and by dump().
+    Histograms filled in worker processes are combined with merge().
+
+    instrumentation = Instrumentation(export_path="instrumentation.json")
+    factory.set_instrumentation(instrumentation)
+    ...
+    instrumentation.dump()
+    '''
+    def __init__(self, export_path=None, export_interval=60., count_objects=True):
+        self.export_path = export_path
+        self.export_interval = export_interval
+        self.count_objects = count_objects
+        self.histograms = defaultdict(StreamingHistogram)
+        self._last_export = time.monotonic()
+
+    def record(self, name, value):
+        self.histograms[name].fill(value)
+        if self.export_path and time.monotonic() - self._last_export > self.export_interval:
+            self.dump()
+
+    def _count_objects(self, ws):
+        return ws.components().getSize() if ws is not None and self.count_objects else 0
+
+    @contextmanager
+    def stage(self, name, ws=None):
+        '''
+        Times the enclosed block and counts the workspace objects it creates.
+        '''
+        objects_before = self._count_objects(ws)
+        start = time.perf_counter()
+        yield
+        self.record(f'{name}_time', time.perf_counter() - start)
+        if ws is not None and self.count_objects:
+            self.record(f'{name}_objects', self._count_objects(ws) - objects_before)
+
+    def merge(self, histograms):
+        '''
+        Adds {name : StreamingHistogram}, as returned by take().
+        '''
+        for name, histogram in histograms.items():
+            self.histograms[name].merge(histogram)
+        if self.export_path and time.monotonic() - self._last_export > self.export_interval:
+            self.dump()
+
+    def take(self):
+        '''
+        Returns the histograms filled so far and starts new ones, so that they are sent only once.
+        '''
+        histograms, self.histograms = dict(self.histograms), defaultdict(StreamingHistogram)
+        return histograms
+
+    def summary(self):
+        return {name : histogram.summary() for name, histogram in sorted(self.histograms.items())}
+
+    def report(self):
+        lines = []
+        for name, summary in self.summary().items():
+            lines.append(f"{name:45s} n={summary['entries']:8d} mean={summary['mean']:.3g} p90<={summary['p90']:.3g} max={summary['max']:.3g}")
+        return '\n'.join(lines)
+
+    def dump(self, path=None):
+        '''
+        Returns the histograms as a dictionary, and writes them as JSON to path or export_path if one is set.
+        '''
+        content = {name : histogram.to_dict() for name, histogram in self.histograms.items()}
+        path = path or self.export_path
+        if path:
+            with open(path, 'w') as f:
+                json.dump(content, f)
+        self._last_export = time.monotonic()
+        return content
@@ -0,0 +1,102 @@
+import math
+import numpy as np
+
+
+class Jet():
+    '''
+    Kinematics of a single jet.
+
+    A lightweight view, e.g. of one entry of a JetCollection.
+    The Cartesian momenta are computed on access.
+    '''
+    __slots__ = ('pt', 'eta', 'phi')
+
+    def __init__(self, pt, eta, phi):
+        self.pt = float(pt)
+        self.eta = float(eta)
+        self.phi = float(phi)
+
+    @property
+    def px(self):
+        return math.cos(self.phi) * self.pt
+
+    @property
+    def py(self):
+        return math.sin(self.phi) * self.pt
+
+    @property
+    def pz(self):
+        return math.sinh(self.eta) * self.pt
+
+    def _key(self):
+        return (self.pt, self.eta, self.phi)
+
+    def __eq__(self, other):
+        return isinstance(other, Jet) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return f"Jet(pt={self.pt}, eta={self.eta}, phi={self.phi})"
+
+
+class JetCollection():
+    '''
+    Array-backed kinematics of the jets of one event, or of a whole chunk.
+
+    px, py and pz are computed for all jets in one vectorized pass.
+    Slicing returns collections that share the underlying arrays,
+    indexing returns a Jet view.
+
+    jets = JetCollection(pt, eta, phi)
+    jets.px, jets[0].pt, len(jets)
+    '''
+    __slots__ = ('pt', 'eta', 'phi', 'px', 'py', 'pz')
+
+    def __init__(self, pt, eta, phi, px=None, py=None, pz=None):
+        self.pt = np.asarray(pt, dtype=np.float64)
+        self.eta = np.asarray(eta, dtype=np.float64)
+        self.phi = np.asarray(phi, dtype=np.float64)
+        self.px = np.cos(self.phi) * self.pt if px is None else px
+        self.py = np.sin(self.phi) * self.pt if py is None else py
+        self.pz = np.sinh(self.eta) * self.pt if pz is None else pz
+
+    @classmethod
+    def from_jets(cls, jets):
+        '''
+        Converts a list of Jet objects, collections are returned unchanged.
+        '''
+        if isinstance(jets, cls):
+            return jets
+        values = np.array([(jet.pt, jet.eta, jet.phi) for jet in jets], dtype=np.float64).reshape(-1, 3)
+        return cls(values[:, 0], values[:, 1], values[:, 2])
+
+    def split(self, counts):
+        '''
+        Splits a chunk-wide collection into one collection per event.
+        '''
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        return [self[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+
+    def momentum(self, direction):
+        return getattr(self, direction)
+
+    def __len__(self):
+        return len(self.pt)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            # Views of the existing arrays, without going through __init__
+            view = JetCollection.__new__(JetCollection)
+            for name in self.__slots__:
+                setattr(view, name, getattr(self, name)[index])
+            return view
+        return Jet(self.pt[index], self.eta[index], self.phi[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __repr__(self):
+        return f"JetCollection(njets={len(self)})"
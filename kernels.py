@@ -0,0 +1,223 @@
+import fcntl
+import hashlib
+import os
+import numpy as np
+from lazyroot import r
+
+_default_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'rebalance', 'kernels')
+
+# Kernels already loaded into this process, by (njets, coordinates)
+_loaded_kernels = {}
+
+
+class LikelihoodKernel():
+    '''
+    Compiled C++ NLL and gradient for a fixed jet multiplicity and coordinate mode.
+
+    The source is generated once, compiled with ACLiC into a shared library
+    inside the cache directory and reused by later processes and runs.
+    The file names contain a hash of the source, so changes to the
+    generated code never pick up stale libraries.
+
+    Argument layout of the array functions for pt/phi coordinates:
+    gen_pt[n], reco_pt[n], sigma_pt[n], gen_phi[n], prior slope.
+    For px/py coordinates:
+    gen_px[n], gen_py[n], reco_px[n], reco_py[n], sigma_along[n], sigma_across[n], prior slope,
+    with the resolutions along and across the reco jet direction. Both are
+    inputs, the factory sets sigma_across from its transverse_resolution.
+    '''
+    _coordinates = ('pt_phi', 'px_py')
+
+    def __init__(self, njets, coordinates='pt_phi', cache_dir=None):
+        if coordinates not in self._coordinates:
+            raise ValueError(f"No compiled kernel for coordinates: '{coordinates}'")
+        self.njets = njets
+        self.coordinates = coordinates
+        self.cache_dir = cache_dir or os.environ.get('REBALANCE_KERNEL_DIR', _default_cache_dir)
+        self._loaded = False
+
+    @property
+    def name(self):
+        return f"rebalance_nll_{self.coordinates}_{self.njets}"
+
+    @property
+    def nll_function_name(self):
+        '''
+        Name of the function taking one scalar per argument, for use inside RooFormulaVar.
+        '''
+        return self.name
+
+    @property
+    def nparameters(self):
+        '''
+        Number of gen momenta, which come first in the argument list.
+        '''
+        return 2 * self.njets if self.coordinates == 'px_py' else self.njets
+
+    @property
+    def narguments(self):
+        return 3 * self.nparameters + 1 if self.coordinates == 'px_py' else 4 * self.njets + 1
+
+    def source(self):
+        arguments = ', '.join(f'double a{i}' for i in range(self.narguments))
+        values = ', '.join(f'a{i}' for i in range(self.narguments))
+        if self.coordinates == 'px_py':
+            body = self._source_px_py()
+        else:
+            body = self._source_pt_phi()
+        return f'''// Generated by kernels.py, do not edit.
+#include <cmath>
+{body}
+double {self.name}({arguments}) {{
+    const double x[] = {{{values}}};
+    return {self.name}_array(x);
+}}
+'''
+
+    def _source_px_py(self):
+        n = self.njets
+        return f'''
+// Gaussian of each jet in its own frame, along and across the reco jet direction
+double {self.name}_array(const double* x) {{
+    constexpr int n = {n};
+    const double* gen = x;
+    const double* reco = x + 2*n;
+    const double* sigma = x + 4*n;
+    const double slope = x[6*n];
+    double nll = 0, htmiss_x = 0, htmiss_y = 0;
+    for (int i = 0; i < n; ++i) {{
+        const double norm = std::sqrt(reco[i]*reco[i] + reco[n+i]*reco[n+i]);
+        const double cos_phi = reco[i] / norm, sin_phi = reco[n+i] / norm;
+        const double dx = reco[i] - gen[i], dy = reco[n+i] - gen[n+i];
+        const double along = (dx * cos_phi + dy * sin_phi) / sigma[i];
+        const double across = (-dx * sin_phi + dy * cos_phi) / sigma[n+i];
+        nll += 0.5 * (along * along + across * across);
+        htmiss_x += gen[i];
+        htmiss_y += gen[n+i];
+    }}
+    return nll - slope * std::sqrt(htmiss_x*htmiss_x + htmiss_y*htmiss_y);
+}}
+
+void {self.name}_gradient(const double* x, double* gradient) {{
+    constexpr int n = {n};
+    const double* gen = x;
+    const double* reco = x + 2*n;
+    const double* sigma = x + 4*n;
+    const double slope = x[6*n];
+    double htmiss_x = 0, htmiss_y = 0;
+    for (int i = 0; i < n; ++i) {{
+        htmiss_x += gen[i];
+        htmiss_y += gen[n+i];
+    }}
+    const double htmiss = std::sqrt(htmiss_x*htmiss_x + htmiss_y*htmiss_y);
+    for (int i = 0; i < n; ++i) {{
+        const double norm = std::sqrt(reco[i]*reco[i] + reco[n+i]*reco[n+i]);
+        const double cos_phi = reco[i] / norm, sin_phi = reco[n+i] / norm;
+        const double dx = reco[i] - gen[i], dy = reco[n+i] - gen[n+i];
+        const double along = (dx * cos_phi + dy * sin_phi) / (sigma[i] * sigma[i]);
+        const double across = (-dx * sin_phi + dy * cos_phi) / (sigma[n+i] * sigma[n+i]);
+        gradient[i] = -(along * cos_phi - across * sin_phi);
+        gradient[n+i] = -(along * sin_phi + across * cos_phi);
+    }}
+    if (htmiss > 0) {{
+        for (int i = 0; i < n; ++i) {{
+            gradient[i] -= slope * htmiss_x / htmiss;
+            gradient[n+i] -= slope * htmiss_y / htmiss;
+        }}
+    }}
+}}
+'''
+
+    def _source_pt_phi(self):
+        n = self.njets
+        return f'''
+
+double {self.name}_array(const double* x) {{
+    constexpr int n = {n};
+    const double* gen = x;
+    const double* reco = x + n;
+    const double* sigma = x + 2*n;
+    const double* phi = x + 3*n;
+    const double slope = x[4*n];
+    double nll = 0, htmiss_x = 0, htmiss_y = 0;
+    for (int i = 0; i < n; ++i) {{
+        const double pull = (reco[i] - gen[i]) / sigma[i];
+        nll += 0.5 * pull * pull;
+        htmiss_x += gen[i] * std::cos(phi[i]);
+        htmiss_y += gen[i] * std::sin(phi[i]);
+    }}
+    return nll - slope * std::sqrt(htmiss_x*htmiss_x + htmiss_y*htmiss_y);
+}}
+
+void {self.name}_gradient(const double* x, double* gradient) {{
+    constexpr int n = {n};
+    const double* gen = x;
+    const double* reco = x + n;
+    const double* sigma = x + 2*n;
+    const double* phi = x + 3*n;
+    const double slope = x[4*n];
+    double htmiss_x = 0, htmiss_y = 0;
+    for (int i = 0; i < n; ++i) {{
+        htmiss_x += gen[i] * std::cos(phi[i]);
+        htmiss_y += gen[i] * std::sin(phi[i]);
+    }}
+    const double htmiss = std::sqrt(htmiss_x*htmiss_x + htmiss_y*htmiss_y);
+    for (int i = 0; i < n; ++i) {{
+        gradient[i] = (gen[i] - reco[i]) / (sigma[i] * sigma[i]);
+        if (htmiss > 0) {{
+            gradient[i] -= slope * (htmiss_x * std::cos(phi[i]) + htmiss_y * std::sin(phi[i])) / htmiss;
+        }}
+    }}
+}}
+'''
+
+    def _source_path(self, source):
+        digest = hashlib.sha1(source.encode()).hexdigest()[:12]
+        return os.path.join(self.cache_dir, f"{self.name}_{digest}.C")
+
+    def load(self):
+        '''
+        Compiles the kernel if no up-to-date library exists on disk and loads it.
+        '''
+        if self._loaded:
+            return self
+        source = self.source()
+        path = self._source_path(source)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Several workers may try to build the same kernel at once
+        with open(path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(path):
+                with open(path + '.tmp', 'w') as f:
+                    f.write(source)
+                os.replace(path + '.tmp', path)
+            if not r.gSystem.CompileMacro(path, 'kO'):
+                raise RuntimeError(f"Could not compile likelihood kernel: '{path}'")
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        self._nll = getattr(r, f"{self.name}_array")
+        self._gradient = getattr(r, f"{self.name}_gradient")
+        self._loaded = True
+        return self
+
+    def nll(self, x):
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        return self._nll(x)
+
+    def gradient(self, x):
+        '''
+        Gradient with respect to the gen momenta, i.e. the first nparameters arguments.
+        '''
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        gradient = np.zeros(self.nparameters)
+        self._gradient(x, gradient)
+        return gradient
+
+
+def get_kernel(njets, coordinates='pt_phi', cache_dir=None):
+    '''
+    Returns the loaded kernel for a jet multiplicity, compiling it on first use.
+    '''
+    key = (njets, coordinates)
+    if key not in _loaded_kernels:
+        _loaded_kernels[key] = LikelihoodKernel(njets, coordinates, cache_dir).load()
+    return _loaded_kernels[key]
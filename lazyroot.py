@@ -0,0 +1,33 @@
+import sys
+
+
+class _LazyROOT():
+    '''
+    Stand-in for the ROOT module that imports ROOT and loads RooFit on first attribute access.
+
+    Modules use it as "from lazyroot import r", so that importing them,
+    e.g. for the NumPy backend or the lookup tables, does not pay for
+    ROOT until a workspace is actually built.
+    '''
+    def __init__(self):
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            import ROOT
+            ROOT.gSystem.Load('libRooFit')
+            self._module = ROOT
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+
+r = _LazyROOT()
+
+
+def is_loaded():
+    '''
+    True once ROOT has been imported in this process, by this module or elsewhere.
+    '''
+    return 'ROOT' in sys.modules
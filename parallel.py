@@ -0,0 +1,354 @@
+import argparse
+import multiprocessing as mp
+import os
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+import uproot
+
+
+@dataclass
+class RangeResult():
+    entry_start: int
+    entry_stop: int
+    pid: int
+    wall_time: float
+    events: list = field(default_factory=list)
+    rss_mb: float = 0.
+    # The worker stays above its memory budget and needs to be replaced
+    recycle: bool = False
+    # Instrumentation histograms filled during this range, by name
+    instrumentation: dict = None
+
+
+@dataclass
+class WorkerStats():
+    events: int = 0
+    ranges: int = 0
+    busy_time: float = 0.
+    rss_mb: float = 0.
+
+    @property
+    def throughput(self):
+        return self.events / self.busy_time if self.busy_time else 0.
+
+
+# Per-process state, filled once by _init_worker
+_worker = {}
+
+
+def _init_worker(jer_source, cache_size, htmiss_prior_source=None, fit_cache=None, max_rss_mb=None, fit_engine=None,
+                 significance_threshold=None, instrument=False):
+    '''
+    Runs once per worker process: loads ROOT, RooFit, the JER tables and the HTmiss prior if requested.
+
+    fit_cache is an optional (filepath, configuration) of a cache.FitResultCache.
+    fit_engine are the arguments of a fitting.AdaptiveFitter, None for plain Migrad.
+    With significance_threshold, events with a smaller reco HTmiss significance
+    take the closed-form solution of batch.BatchRebalancer instead of a fit.
+    With instrument=True, stage timings and fit statistics are collected
+    and sent back with every range.
+    '''
+    import ROOT as r
+    r.gSystem.Load('libRooFit')
+    r.RooMsgService.instance().setGlobalKillBelow(r.RooFit.WARNING)
+    from rebalance import RebalanceWSCache
+    _worker['ROOT'] = r
+    prior = 'histogram' if htmiss_prior_source is not None else 'exponential'
+    if instrument:
+        from instrument import Instrumentation
+        _worker['instrumentation'] = Instrumentation()
+    _worker['cache'] = RebalanceWSCache(
+        max_size=cache_size,
+        jer_source=jer_source,
+        htmiss_prior_source=htmiss_prior_source,
+        max_rss_mb=max_rss_mb,
+        instrumentation=_worker.get('instrumentation'),
+        prior=prior
+    )
+    _worker['fit_engine'] = fit_engine
+    if significance_threshold is not None:
+        from batch import BatchRebalancer
+        from rebalance import HTMissPriorLookup
+        rebalancer = BatchRebalancer(prior=HTMissPriorLookup(*htmiss_prior_source) if htmiss_prior_source is not None else None)
+        rebalancer.set_jer_source(*jer_source)
+        _worker['prefilter'] = (rebalancer, significance_threshold)
+    if fit_cache is not None:
+        from cache import FitResultCache
+        _worker['fit_cache'] = FitResultCache(*fit_cache)
+
+
+def _fit_event(jets):
+    from fitting import AdaptiveFitter, fit_record, run_migrad
+    factory = _worker['cache'].get(jets)
+    fit_engine = _worker.get('fit_engine')
+    if fit_engine is not None:
+        result = AdaptiveFitter(factory, **fit_engine).fit()
+    else:
+        result = run_migrad(factory)
+    return fit_record(factory, result)
+
+
+def _fit_chunk(chunk):
+    '''
+    Rebalances one chunk, sending only the events without a closed-form solution to the fit.
+
+    Fit results of the remaining events are looked up in the fit cache in one query
+    per chunk, and new results are written back in one transaction per chunk.
+    '''
+    from batch import fit_records
+    entries = range(chunk.entry_start, chunk.entry_stop)
+    events = list(chunk.events())
+    if 'prefilter' in _worker:
+        rebalancer, threshold = _worker['prefilter']
+        pt, eta, phi, mask = chunk.padded()
+        result = rebalancer.balance(pt, eta, phi, mask, significance_threshold=threshold)
+        analytic = result.analytic
+        balanced = iter(fit_records(result, pt, eta, phi))
+    else:
+        analytic = [False] * len(events)
+    fitted = [jets for jets, closed_form in zip(events, analytic) if not closed_form]
+    fit_cache = _worker.get('fit_cache')
+    cached = iter(fit_cache.get_many(fitted) if fit_cache is not None else [None] * len(fitted))
+    records, new_events, new_records = [], [], []
+    for entry, jets, closed_form in zip(entries, events, analytic):
+        if closed_form:
+            record = next(balanced)
+        else:
+            record = next(cached)
+            if record is None:
+                record = _fit_event(jets)
+                new_events.append(jets)
+                new_records.append(record)
+        record['entry'] = entry
+        records.append(record)
+    if fit_cache is not None:
+        fit_cache.put_many(new_events, new_records)
+    return records
+
+
+def _process_range(filepath, treename, entry_start, entry_stop, step_size):
+    '''
+    Rebalances all events in [entry_start, entry_stop) inside a worker.
+    '''
+    from reader import JetReader
+    from instrument import current_rss_mb
+    start_time = time.perf_counter()
+    reader = JetReader(
+        filepath,
+        treename=treename,
+        step_size=step_size,
+        entry_start=entry_start,
+        entry_stop=entry_stop
+    )
+    events = []
+    for chunk in reader:
+        events.extend(_fit_chunk(chunk))
+    return RangeResult(
+        entry_start=entry_start,
+        entry_stop=entry_stop,
+        pid=os.getpid(),
+        wall_time=time.perf_counter() - start_time,
+        events=events,
+        rss_mb=current_rss_mb(),
+        recycle=_worker['cache'].over_budget(),
+        instrumentation=_worker['instrumentation'].take() if 'instrumentation' in _worker else None
+    )
+
+
+class ParallelDriver():
+    '''
+    Runs the build-and-migrad cycle for one input file in a pool of worker processes.
+
+    The input is split into entry ranges that are processed independently.
+    Results are handed to the writer in the parent process as soon as
+    a range finishes. If a worker stays above max_rss_mb after releasing its
+    templates, no further ranges are submitted to the pool, and the remaining
+    ranges run in a new pool once the running ones have finished.
+
+    driver = ParallelDriver("tree_22.root", nworkers=8)
+    driver.run(writer=lambda result: ...)
+    print(driver.report())
+    '''
+    def __init__(self, filepath, jer_source=("./input/jer.root", "jer_data"), nworkers=None,
+                 range_size=500, treename='Events', step_size=10000, cache_size=32, htmiss_prior_source=None,
+                 fit_cache_path=None, max_rss_mb=None, max_ranges_per_worker=None, fit_engine=None,
+                 significance_threshold=None, instrumentation=None):
+        self.filepath = filepath
+        self.jer_source = jer_source
+        self.htmiss_prior_source = htmiss_prior_source
+        self.fit_cache_path = fit_cache_path
+        self.max_rss_mb = max_rss_mb
+        # Workers are replaced by fresh processes after this many ranges
+        self.max_ranges_per_worker = max_ranges_per_worker
+        # Arguments of fitting.AdaptiveFitter, None for plain Migrad
+        self.fit_engine = fit_engine
+        # Events below this reco HTmiss significance are not fitted
+        self.significance_threshold = significance_threshold
+        # instrument.Instrumentation that collects the histograms of all workers
+        self.instrumentation = instrumentation
+        self.nworkers = nworkers or os.cpu_count()
+        self.range_size = range_size
+        self.treename = treename
+        self.step_size = step_size
+        self.cache_size = cache_size
+        self.worker_stats = defaultdict(WorkerStats)
+        self.tier_counts = Counter()
+        self.pool_restarts = 0
+        self.wall_time = 0.
+
+    def ranges(self, entry_start=0, entry_stop=None):
+        if entry_stop is None:
+            with uproot.open(self.filepath) as f:
+                entry_stop = f[self.treename].num_entries
+        return [(start, min(start + self.range_size, entry_stop))
+                for start in range(entry_start, entry_stop, self.range_size)]
+
+    def run(self, writer=None, entry_start=0, entry_stop=None):
+        '''
+        Processes all entry ranges and returns the number of processed events.
+        '''
+        self.worker_stats.clear()
+        self.tier_counts.clear()
+        self.pool_restarts = 0
+        start_time = time.perf_counter()
+        fit_cache = None
+        if self.fit_cache_path is not None:
+            from cache import fit_configuration
+            # Plain Migrad keeps the configuration, and the cache entries, from before fit engines
+            extra = {'fit_engine' : self.fit_engine} if self.fit_engine is not None else {}
+            configuration = fit_configuration(
+                self.jer_source,
+                prior='histogram' if self.htmiss_prior_source is not None else 'exponential',
+                htmiss_prior_source=self.htmiss_prior_source,
+                **extra
+            )
+            fit_cache = (self.fit_cache_path, configuration)
+        initargs = (self.jer_source, self.cache_size, self.htmiss_prior_source, fit_cache, self.max_rss_mb,
+                    self.fit_engine, self.significance_threshold, self.instrumentation is not None)
+        pending = deque(self.ranges(entry_start, entry_stop))
+        while pending:
+            if self._run_pool(pending, initargs, writer) and pending:
+                self.pool_restarts += 1
+        self.wall_time = time.perf_counter() - start_time
+        return sum(x.events for x in self.worker_stats.values())
+
+    def _run_pool(self, pending, initargs, writer):
+        '''
+        Processes ranges from pending in one pool, returns True if a worker asked to be replaced.
+
+        Two ranges per worker are in flight, so that a pool that needs replacing
+        only finishes the ranges it already started.
+        '''
+        # Fresh interpreters, so that every worker initializes ROOT itself
+        context = mp.get_context('spawn')
+        recycle = False
+        with ProcessPoolExecutor(
+            max_workers=self.nworkers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=initargs,
+            max_tasks_per_child=self.max_ranges_per_worker
+        ) as pool:
+            futures = set()
+            while futures or (pending and not recycle):
+                while pending and not recycle and len(futures) < 2 * self.nworkers:
+                    start, stop = pending.popleft()
+                    futures.add(pool.submit(_process_range, self.filepath, self.treename, start, stop, self.step_size))
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    recycle |= result.recycle
+                    self._collect(result, writer)
+        return recycle
+
+    def _collect(self, result, writer):
+        stats = self.worker_stats[result.pid]
+        stats.events += len(result.events)
+        stats.ranges += 1
+        stats.busy_time += result.wall_time
+        stats.rss_mb = max(stats.rss_mb, result.rss_mb)
+        self.tier_counts.update(record['tier'] for record in result.events)
+        if self.instrumentation is not None and result.instrumentation:
+            self.instrumentation.merge(result.instrumentation)
+        if writer is not None:
+            writer(result)
+
+    def report(self):
+        lines = []
+        for pid, stats in sorted(self.worker_stats.items()):
+            lines.append(f"worker {pid}: {stats.events} events in {stats.ranges} ranges, {stats.throughput:.1f} events/s, "
+                         f"max RSS {stats.rss_mb:.0f} MB")
+        total = sum(x.events for x in self.worker_stats.values())
+        if self.significance_threshold is not None and total:
+            analytic = self.tier_counts[-1]
+            lines.append(f"pre-filter: {analytic / total:.1%} of events analytic, {1 - analytic / total:.1%} fitted")
+        if self.fit_engine is not None and total:
+            lines.append("fits per tier: " + ', '.join(f"{tier}: {n / total:.1%}" for tier, n in sorted(self.tier_counts.items()) if tier >= 0))
+        if self.pool_restarts:
+            lines.append(f"pool restarted {self.pool_restarts} times, workers above {self.max_rss_mb:.0f} MB")
+        if self.wall_time:
+            lines.append(f"total: {total} events in {self.wall_time:.1f} s, {total / self.wall_time:.1f} events/s with {self.nworkers} workers")
+        return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebalance all events of a file in parallel.")
+    parser.add_argument('filepath')
+    parser.add_argument('--output', default='rebalanced.root')
+    parser.add_argument('--nworkers', type=int, default=None)
+    parser.add_argument('--range-size', type=int, default=500)
+    parser.add_argument('--jer', default='./input/jer.root', help="JER file, or a directory written by tables.py")
+    parser.add_argument('--htmiss-prior', default=None, help="Use the histogram HTmiss prior from this file or tables directory")
+    parser.add_argument('--year', type=int, default=2017)
+    parser.add_argument('--fit-cache', default=None, help="Reuse fit results stored in this SQLite file")
+    parser.add_argument('--max-rss-mb', type=float, default=None, help="Release cached workspaces above this RSS")
+    parser.add_argument('--max-ranges-per-worker', type=int, default=None, help="Recycle worker processes after this many ranges")
+    parser.add_argument('--adaptive', action='store_true', help="Escalate the Migrad strategy only for events that need it")
+    parser.add_argument('--max-calls', type=int, default=None, help="NLL evaluations per event with --adaptive")
+    parser.add_argument('--timeout', type=float, default=None, help="Seconds per event with --adaptive")
+    parser.add_argument('--significance-threshold', type=float, default=None,
+                        help="Skip the fit for events with a smaller reco HTmiss significance")
+    parser.add_argument('--instrumentation', default=None, help="Write stage timings and fit statistics to this JSON file")
+    parser.add_argument('--plot-sample', choices=('random', 'worst_nll'), default=None)
+    parser.add_argument('--plot-fraction', type=float, default=0.001)
+    parser.add_argument('--plot-dir', default='plots')
+    args = parser.parse_args()
+
+    from writer import FitResultWriter
+    from plotting import PlotSampler
+    from instrument import Instrumentation
+    instrumentation = Instrumentation(export_path=args.instrumentation) if args.instrumentation else None
+    htmiss_prior_source = (args.htmiss_prior, args.year) if args.htmiss_prior else None
+    driver = ParallelDriver(
+        args.filepath,
+        jer_source=(args.jer, 'jer_data'),
+        nworkers=args.nworkers,
+        range_size=args.range_size,
+        htmiss_prior_source=htmiss_prior_source,
+        fit_cache_path=args.fit_cache,
+        max_rss_mb=args.max_rss_mb,
+        max_ranges_per_worker=args.max_ranges_per_worker,
+        fit_engine={'max_calls' : args.max_calls, 'timeout' : args.timeout} if args.adaptive else None,
+        significance_threshold=args.significance_threshold,
+        instrumentation=instrumentation
+    )
+    # Summary histograms are always filled, event plots only for the sample
+    plots = PlotSampler(args.plot_dir, sample=args.plot_sample, fraction=args.plot_fraction)
+
+    def write(result):
+        writer.fill_many(result.events)
+        for record in result.events:
+            plots.add(record['entry'], record)
+
+    with FitResultWriter(args.output) as writer, plots:
+        driver.run(writer=write)
+    print(driver.report())
+    if instrumentation is not None:
+        instrumentation.dump()
+        print(instrumentation.report())
+
+
+if __name__ == "__main__":
+    main()
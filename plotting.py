@@ -0,0 +1,213 @@
+import heapq
+import json
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import numpy as np
+
+
+@dataclass
+class PlaneData():
+    '''
+    Transverse momenta of one event, extracted so that rendering does not need the workspace.
+    '''
+    tag: str
+    reco_x: np.ndarray
+    reco_y: np.ndarray
+    gen_x: np.ndarray
+    gen_y: np.ndarray
+    nll: float
+
+
+def _transverse(record, tier):
+    if f'{tier}_px' in record:
+        return np.asarray(record[f'{tier}_px'], dtype=float), np.asarray(record[f'{tier}_py'], dtype=float)
+    pt = np.asarray(record[f'{tier}_pt'], dtype=float)
+    phi = np.asarray(record[f'{tier}_phi'], dtype=float)
+    return pt * np.cos(phi), pt * np.sin(phi)
+
+
+def plane_data(record, tag):
+    '''
+    Before and after fit views of a fitting.fit_record() dictionary.
+    '''
+    reco_x, reco_y = _transverse(record, 'reco')
+    gen_x, gen_y = _transverse(record, 'gen')
+    return (
+        PlaneData(f"{tag}_before", reco_x, reco_y, reco_x, reco_y, record['nll_before']),
+        PlaneData(f"{tag}_after", reco_x, reco_y, gen_x, gen_y, record['nll']),
+    )
+
+
+def render_plane(data, output_dir, dpi=300):
+    '''
+    Draws reco and gen jets plus HTmiss in the transverse plane. Runs inside the render pool.
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+
+    fig, ax = plt.subplots()
+    for i in range(len(data.reco_x)):
+        ax.arrow(x=0, y=0, dx=data.reco_x[i], dy=data.reco_y[i], head_width=10,
+                 color='navy', label='Reco jet' if i==0 else None)
+        ax.arrow(x=0, y=0, dx=data.gen_x[i], dy=data.gen_y[i], head_width=10,
+                 color='crimson', label='Gen jet' if i==0 else None)
+
+    reco_htx, reco_hty = -np.sum(data.reco_x), -np.sum(data.reco_y)
+    gen_htx, gen_hty = -np.sum(data.gen_x), -np.sum(data.gen_y)
+    reco_ht = np.hypot(reco_htx, reco_hty)
+    gen_ht = np.hypot(gen_htx, gen_hty)
+    ax.arrow(x=0, y=0, dx=reco_htx, dy=reco_hty, head_width=10, color='navy', width=10, alpha=0.5,
+             label=f'Reco $H_{{T}}^{{miss}}$ ({reco_ht:.0f} GeV)')
+    ax.arrow(x=0, y=0, dx=gen_htx, dy=gen_hty, head_width=10, color='crimson', width=10, alpha=0.5,
+             label=f'Gen $H_{{T}}^{{miss}}$ ({gen_ht:.0f} GeV)')
+
+    axis_maximum = 1.2 * max(np.max(np.abs(np.concatenate([data.reco_x, data.reco_y]))), reco_ht)
+    ax.set_ylim(-axis_maximum, axis_maximum)
+    ax.set_xlim(-axis_maximum, axis_maximum)
+    ax.set_title(f"{data.tag}, NLL = {data.nll:.2f}")
+    ax.legend()
+    path = os.path.join(output_dir, f"test_{data.tag}.png")
+    fig.savefig(path, dpi=dpi)
+    plt.close(fig)
+    return path
+
+
+class HTMissSummary():
+    '''
+    Reco vs. rebalanced HTmiss histograms, filled incrementally across events.
+    '''
+    def __init__(self, edges=None):
+        self.edges = np.asarray(edges, dtype=float) if edges is not None else np.linspace(0, 500, 51)
+        nbins = len(self.edges) - 1
+        self.reco = np.zeros(nbins, dtype=np.int64)
+        self.gen = np.zeros(nbins, dtype=np.int64)
+        self.reco_vs_gen = np.zeros((nbins, nbins), dtype=np.int64)
+        self.entries = 0
+
+    def fill(self, reco_htmiss, gen_htmiss):
+        '''
+        Adds one event or arrays of events. Overflow goes into the last bin.
+        '''
+        nbins = len(self.edges) - 1
+        reco_bin = np.clip(np.searchsorted(self.edges, reco_htmiss, side='right') - 1, 0, nbins - 1)
+        gen_bin = np.clip(np.searchsorted(self.edges, gen_htmiss, side='right') - 1, 0, nbins - 1)
+        np.add.at(self.reco, reco_bin, 1)
+        np.add.at(self.gen, gen_bin, 1)
+        np.add.at(self.reco_vs_gen, (reco_bin, gen_bin), 1)
+        self.entries += np.size(reco_htmiss)
+
+    def fill_record(self, record):
+        reco_x, reco_y = _transverse(record, 'reco')
+        gen_x, gen_y = _transverse(record, 'gen')
+        self.fill(np.hypot(reco_x.sum(), reco_y.sum()), np.hypot(gen_x.sum(), gen_y.sum()))
+
+    def to_dict(self):
+        return {
+            'entries' : int(self.entries),
+            'edges' : self.edges.tolist(),
+            'reco' : self.reco.tolist(),
+            'gen' : self.gen.tolist(),
+            'reco_vs_gen' : self.reco_vs_gen.tolist(),
+        }
+
+
+def render_summary(summary, output_dir, dpi=150):
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+
+    edges = np.asarray(summary['edges'])
+    fig, (left, right) = plt.subplots(1, 2, figsize=(12, 5))
+    left.stairs(summary['reco'], edges, color='navy', label='Reco')
+    left.stairs(summary['gen'], edges, color='crimson', label='Rebalanced')
+    left.set_xlabel('$H_{T}^{miss}$ (GeV)')
+    left.set_yscale('log')
+    left.legend()
+    right.pcolormesh(edges, edges, np.asarray(summary['reco_vs_gen']).T, norm=matplotlib.colors.LogNorm())
+    right.set_xlabel('Reco $H_{T}^{miss}$ (GeV)')
+    right.set_ylabel('Rebalanced $H_{T}^{miss}$ (GeV)')
+    path = os.path.join(output_dir, "htmiss_summary.png")
+    fig.savefig(path, dpi=dpi)
+    plt.close(fig)
+    return path
+
+
+class PlotSampler():
+    '''
+    Optional plotting stage that renders a sample of events off the fitting thread.
+
+    With sample='random', each event is plotted with probability fraction
+    and rendered right away. With sample='worst_nll', the nworst events with
+    the largest NLL after the fit are kept and rendered by close().
+    Rendering runs in a separate process pool from extracted arrays.
+    The HTmiss summary histograms are filled for every event.
+
+    with PlotSampler("./output", sample='worst_nll', nworst=20) as plots:
+        plots.add(entry, fit_record(factory, result))
+    '''
+    _sample_modes = (None, 'random', 'worst_nll')
+
+    def __init__(self, output_dir, sample='random', fraction=0.01, nworst=20, nworkers=1, dpi=300, seed=0):
+        if sample not in self._sample_modes:
+            raise ValueError(f"Unknown sample mode: '{sample}'")
+        self.output_dir = output_dir
+        self.sample = sample
+        self.fraction = fraction
+        self.nworst = nworst
+        self.nworkers = nworkers
+        self.dpi = dpi
+        self.summary = HTMissSummary()
+        self._rng = np.random.default_rng(seed)
+        self._worst = []
+        self._pool = None
+        self._futures = []
+
+    def _submit(self, function, *args):
+        if self._pool is None:
+            os.makedirs(self.output_dir, exist_ok=True)
+            # matplotlib stays out of the fitting process
+            self._pool = ProcessPoolExecutor(max_workers=self.nworkers, mp_context=mp.get_context('spawn'))
+        self._futures.append(self._pool.submit(function, *args))
+
+    def _render(self, record, tag):
+        for data in plane_data(record, tag):
+            self._submit(render_plane, data, self.output_dir, self.dpi)
+
+    def add(self, entry, record):
+        self.summary.fill_record(record)
+        if self.sample == 'random' and self._rng.uniform() < self.fraction:
+            self._render(record, entry)
+        elif self.sample == 'worst_nll':
+            item = (record['nll'], entry, record)
+            if len(self._worst) < self.nworst:
+                heapq.heappush(self._worst, item)
+            elif item[:2] > self._worst[0][:2]:
+                heapq.heapreplace(self._worst, item)
+
+    def close(self):
+        '''
+        Renders the pending plots and the summary, and waits for the pool.
+        '''
+        for _, entry, record in self._worst:
+            self._render(record, entry)
+        self._worst = []
+        if self.summary.entries:
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(os.path.join(self.output_dir, "htmiss_summary.json"), 'w') as f:
+                json.dump(self.summary.to_dict(), f)
+            self._submit(render_summary, self.summary.to_dict(), self.output_dir)
+        paths = [future.result() for future in self._futures]
+        self._futures = []
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        return paths
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,106 @@
+from dataclasses import dataclass
+import awkward as ak
+import numpy as np
+import uproot
+from jets import JetCollection
+
+
+@dataclass
+class JetChunk():
+    '''
+    Jagged jet kinematics for a contiguous range of events.
+    '''
+    entry_start: int
+    pt: ak.Array
+    eta: ak.Array
+    phi: ak.Array
+
+    def __len__(self):
+        return len(self.pt)
+
+    @property
+    def entry_stop(self):
+        return self.entry_start + len(self)
+
+    @property
+    def njets(self):
+        return ak.to_numpy(ak.num(self.pt))
+
+    def padded(self):
+        '''
+        Padded (nevents, max_njets) arrays of pt, eta, phi plus the jet mask,
+        as expected by batch.BatchRebalancer.fit.
+        '''
+        width = max(int(ak.max(ak.num(self.pt), initial=0)), 1)
+        arrays = []
+        for values in (self.pt, self.eta, self.phi):
+            padded = ak.pad_none(values, width, axis=1, clip=True)
+            arrays.append(ak.to_numpy(ak.fill_none(padded, 0.)).astype(float))
+        mask = np.arange(width)[None, :] < self.njets[:, None]
+        return (*arrays, mask)
+
+    def jets(self):
+        '''
+        All jets of the chunk as one JetCollection, with momenta computed in one pass.
+        '''
+        return JetCollection(*(ak.to_numpy(ak.flatten(x)).astype(float) for x in (self.pt, self.eta, self.phi)))
+
+    def events(self):
+        '''
+        Yields one JetCollection per event, sharing the arrays of the chunk.
+        '''
+        yield from self.jets().split(self.njets)
+
+
+class JetReader():
+    '''
+    Streams jets from one or more flat trees in chunks.
+
+    The chunk size is either a number of entries or a memory budget
+    understood by uproot, e.g. "100 MB".
+
+    reader = JetReader("tree_22.root", step_size="100 MB")
+    for chunk in reader:
+        pt, eta, phi, mask = chunk.padded()
+    '''
+    def __init__(self, files, treename='Events', step_size=10000, entry_start=None, entry_stop=None, prefix='Jet'):
+        self.files = [files] if isinstance(files, str) else list(files)
+        self.treename = treename
+        self.step_size = step_size
+        self.entry_start = entry_start
+        self.entry_stop = entry_stop
+        self._branches = {x : f'{prefix}_{x}' for x in ('pt', 'eta', 'phi')}
+
+    def _iterate(self):
+        if self.entry_start is None and self.entry_stop is None:
+            return uproot.iterate(
+                [f"{x}:{self.treename}" for x in self.files],
+                list(self._branches.values()),
+                step_size=self.step_size,
+                report=True
+            )
+        # Entry ranges are defined per tree
+        if len(self.files) != 1:
+            raise ValueError("Entry ranges are only supported for a single input file.")
+        tree = uproot.open(self.files[0])[self.treename]
+        return tree.iterate(
+            list(self._branches.values()),
+            step_size=self.step_size,
+            entry_start=self.entry_start,
+            entry_stop=self.entry_stop,
+            report=True
+        )
+
+    def __iter__(self):
+        for arrays, report in self._iterate():
+            yield JetChunk(
+                entry_start=report.tree_entry_start,
+                **{x : arrays[branch] for x, branch in self._branches.items()}
+            )
+
+    def events(self):
+        '''
+        Yields one JetCollection per event across all chunks.
+        '''
+        for chunk in self:
+            yield from chunk.events()
@@ -1,22 +1,12 @@
+from collections import OrderedDict
+import gc
+import re
 from dataclasses import dataclass
-import ROOT as r
-r.gSystem.Load('libRooFit')
 import numpy as np
-
-
-@dataclass(frozen=True)
-class Jet():
-    pt: float
-    eta: float
-    phi: float
-    px: float = 0
-    py: float = 0
-    pz: float = 0
-
-    def __post_init__(self):
-        object.__setattr__(self, 'px', np.cos(self.phi) * self.pt)
-        object.__setattr__(self, 'py', np.sin(self.phi) * self.pt)
-        object.__setattr__(self, 'pz', np.sinh(self.eta) * self.pt)
+from lazyroot import r
+from kernels import get_kernel
+from jets import Jet, JetCollection
+import tables
 
 
 class NamingMixin():
@@ -54,6 +44,25 @@ class NamingMixin():
     def _name_metadata_njets_variable(self):
         return 'njets'
 
+    def _name_jet_nll_term(self, direction, index):
+        return f"nll_{direction}_{index}"
+
+    def _name_prior_nll_term(self):
+        return "nll_prior"
+
+    def _name_gen_htmiss_prior_bin(self):
+        return "gen_htmiss_prior_bin"
+
+    def _name_gen_htmiss_prior_table(self):
+        return "gen_htmiss_prior_table"
+
+
+# Jet resolution perpendicular to the reco jet direction in the px/py model, as a
+# fraction of the pt resolution. The JER input only has the pt resolution, with this
+# fraction the gen jet direction moves by about a tenth of the relative pt resolution
+# in radians, which stays close to the pt/phi model with phi fixed to reco.
+default_transverse_resolution = 0.1
+
 
 def make_RooArgList(items):
     l = r.RooArgList()
@@ -62,89 +71,674 @@ def make_RooArgList(items):
     return l
 
 
+@dataclass
+class WorkspaceValues():
+    '''
+    Reco and gen momenta of all jets of a workspace in both coordinate systems, plus HTmiss and the NLL.
+    '''
+    reco_pt: np.ndarray
+    reco_phi: np.ndarray
+    reco_px: np.ndarray
+    reco_py: np.ndarray
+    gen_pt: np.ndarray
+    gen_phi: np.ndarray
+    gen_px: np.ndarray
+    gen_py: np.ndarray
+    reco_htmiss: float
+    gen_htmiss: float
+    nll: float
+
+    @classmethod
+    def from_momenta(cls, reco, gen, nll):
+        '''
+        Completes {direction : values} of either coordinate system with the other one.
+        '''
+        values = {}
+        for tier, momenta in (('reco', reco), ('gen', gen)):
+            if 'pt' in momenta:
+                pt, phi = momenta['pt'], momenta['phi']
+                px, py = pt * np.cos(phi), pt * np.sin(phi)
+            else:
+                px, py = momenta['px'], momenta['py']
+                pt, phi = np.hypot(px, py), np.arctan2(py, px)
+            values.update({f'{tier}_pt' : pt, f'{tier}_phi' : phi, f'{tier}_px' : px, f'{tier}_py' : py,
+                           f'{tier}_htmiss' : float(np.hypot(np.sum(px), np.sum(py)))})
+        return cls(nll=float(nll), **values)
+
+
+_read_values_cpp = '''
+#include <vector>
+
+std::vector<double> rebalance_read_values(const RooArgList& arguments) {
+    std::vector<double> values;
+    values.reserve(arguments.size());
+    for (const auto* argument : arguments) {
+        values.push_back(static_cast<const RooAbsReal*>(argument)->getVal());
+    }
+    return values;
+}
+'''
+
+_read_values_declared = False
+
+
+def read_values(arguments):
+    '''
+    Values of all RooAbsReal in a RooArgList as a NumPy array, with one call into the interpreter.
+    '''
+    global _read_values_declared
+    if not _read_values_declared:
+        r.gInterpreter.Declare(_read_values_cpp)
+        _read_values_declared = True
+    # Copies out of the std::vector through its array interface
+    return np.array(r.rebalance_read_values(arguments), dtype=float)
+
+
+@dataclass
+class JetFreezePolicy():
+    '''
+    Selects jets whose gen momenta are fixed to the reco values in the fit.
+
+    Jets below pt_min, or beyond the max_floating leading jets in pt, are frozen.
+    Frozen jets still enter gen HT and gen HTmiss, but do not add fit parameters.
+    '''
+    pt_min: float = None
+    max_floating: int = None
+
+    def frozen(self, pt):
+        pt = np.asarray(pt, dtype=float)
+        frozen = np.zeros(pt.shape, dtype=bool)
+        if self.pt_min is not None:
+            frozen |= pt < self.pt_min
+        if self.max_floating is not None:
+            rank = np.argsort(np.argsort(-pt, kind='stable'), kind='stable')
+            frozen |= rank >= self.max_floating
+        return frozen
+
+
+def _balance_multiplier(matrix, htmiss, strength, iterations=60):
+    '''
+    Lagrange multiplier of the HTmiss balance in the linearized fit.
+
+    Minimizes 0.5 * mu.M.mu - mu.h over |mu| <= strength. Without the bound this
+    is full balance, mu = M^-1 h. Otherwise mu = (M + s)^-1 h with s >= 0
+    chosen by bisection such that |mu| = strength.
+    Works on one event as well as on stacks of events, M of shape (..., 2, 2).
+    '''
+    eigenvalues, eigenvectors = np.linalg.eigh(matrix)
+    projection = np.einsum('...ji,...j->...i', eigenvectors, htmiss)
+    # Directions without floating momenta cannot be balanced
+    usable = eigenvalues > 1e-12 * np.maximum(eigenvalues[..., -1:], 1e-300)
+
+    def multiplier(shift):
+        scaled = np.where(usable, projection / np.where(usable, eigenvalues + shift[..., None], 1.), 0.)
+        return np.einsum('...ij,...j->...i', eigenvectors, scaled)
+
+    strength = np.asarray(strength, dtype=float)
+    balanced = multiplier(np.zeros_like(strength))
+    bounded = np.linalg.norm(balanced, axis=-1) > strength
+    if not np.any(bounded):
+        return balanced
+    low = np.zeros_like(strength)
+    high = np.linalg.norm(htmiss, axis=-1) / np.maximum(strength, 1e-300)
+    for _ in range(iterations):
+        shift = 0.5 * (low + high)
+        above = np.linalg.norm(multiplier(shift), axis=-1) > strength
+        low = np.where(above, shift, low)
+        high = np.where(above, high, shift)
+    return np.where(bounded[..., None], multiplier(high), balanced)
+
+
 class HistoSF2D():
+    '''
+    Array-backed lookup of a 2D histogram.
+
+    Bin edges and contents are copied from the TH2 once, afterwards
+    evaluation works on scalars as well as on arrays of any shape.
+    Use from_uproot() to create it without ROOT.
+    '''
     def __init__(self, histogram):
         assert(histogram)
         self._histogram = histogram
+        self._init_arrays()
         self._init_boundaries()
 
-    def _init_boundaries(self):
-        bin_bottom_left = self._histogram.GetBin(1,1)
+    @classmethod
+    def from_arrays(cls, edges_x, edges_y, contents):
+        '''
+        Creates the lookup directly from bin edges and a (nbins_x, nbins_y) content array.
+        '''
+        instance = cls.__new__(cls)
+        instance._histogram = None
+        instance._edges_x = np.asarray(edges_x, dtype=float)
+        instance._edges_y = np.asarray(edges_y, dtype=float)
+        instance._contents = np.asarray(contents, dtype=float)
+        instance._init_boundaries()
+        return instance
+
+    @classmethod
+    def from_uproot(cls, histogram):
+        '''
+        Creates the lookup from a 2D histogram read with uproot.
+        '''
+        return cls.from_arrays(histogram.axis(0).edges(), histogram.axis(1).edges(), histogram.values())
+
+    @classmethod
+    def from_table(cls, arrays):
+        '''
+        Creates the lookup from the arrays of to_table(), e.g. memory-mapped, without copying them.
+        '''
+        instance = cls.__new__(cls)
+        instance._histogram = None
+        instance._edges_x = arrays['edges_x']
+        instance._edges_y = arrays['edges_y']
+        instance._contents = arrays['contents']
+        instance._xmin, instance._xmax, instance._ymin, instance._ymax = (float(x) for x in arrays['bounds'])
+        return instance
+
+    def to_table(self):
+        return {
+            'edges_x' : self._edges_x,
+            'edges_y' : self._edges_y,
+            'contents' : self._contents,
+            'bounds' : np.array([self._xmin, self._xmax, self._ymin, self._ymax]),
+        }
+
+    def _init_arrays(self):
         nbins_x = self._histogram.GetNbinsX()
         nbins_y = self._histogram.GetNbinsY()
-        self._xmin = self._histogram.GetXaxis().GetBinCenter(1)
-        self._xmax = self._histogram.GetXaxis().GetBinCenter(nbins_x-1)
-        self._ymin = self._histogram.GetYaxis().GetBinCenter(1)
-        self._ymax = self._histogram.GetYaxis().GetBinCenter(nbins_y-1)
+        xaxis = self._histogram.GetXaxis()
+        yaxis = self._histogram.GetYaxis()
+        self._edges_x = np.array([xaxis.GetBinLowEdge(i) for i in range(1, nbins_x+2)])
+        self._edges_y = np.array([yaxis.GetBinLowEdge(i) for i in range(1, nbins_y+2)])
+        self._contents = np.array([
+            [self._histogram.GetBinContent(ix, iy) for iy in range(1, nbins_y+1)]
+            for ix in range(1, nbins_x+1)
+        ])
 
+    def _init_boundaries(self):
+        # Centers of the first and the next-to-last bin,
+        # same as TAxis::GetBinCenter(1) and GetBinCenter(nbins-1)
+        centers_x = 0.5 * (self._edges_x[1:] + self._edges_x[:-1])
+        centers_y = 0.5 * (self._edges_y[1:] + self._edges_y[:-1])
+        self._xmin = centers_x[0]
+        self._xmax = centers_x[-2]
+        self._ymin = centers_y[0]
+        self._ymax = centers_y[-2]
 
     def _apply_limit(self, value, low, high):
-        return max(low, min(value, high))
+        return np.clip(value, low, high)
+
+    def _find_bin(self, value, edges):
+        '''
+        Zero-based bin index, equivalent to TAxis::FindBin - 1 for in-range values.
+        '''
+        return np.searchsorted(edges, value, side='right') - 1
 
     def evaluate(self,x,y):
         x = self._apply_limit(x, self._xmin, self._xmax)
         y = self._apply_limit(y, self._ymin, self._ymax)
 
-        bin_id = self._histogram.FindBin(x,y)
-        return self._histogram.GetBinContent(bin_id)
+        values = self._contents[self._find_bin(x, self._edges_x), self._find_bin(y, self._edges_y)]
+        if np.ndim(values) == 0:
+            return float(values)
+        return values
 
     def __call__(self,x,y):
         return self.evaluate(x,y)
 
 class JERLookup():
+    '''
+    Relative jet energy resolution from a ROOT file, or from a directory of tables.export_tables().
+    '''
     def __init__(self, filepath, histogram_name):
-        f = r.TFile(filepath)
-        if not f:
-            raise IOError(f"Could not open file: '{filepath}'")
-
-        h = f.Get(histogram_name)
-        if not f:
-            raise IOError(f"Could not load histogram: '{histogram_name}'")
-
-        h.SetDirectory(0)
-        self._evaluator = HistoSF2D(h)
+        if tables.is_table_directory(filepath):
+            arrays = tables.load_table(tables.table_path(filepath, histogram_name), 'jer')
+            self._evaluator = HistoSF2D.from_table(arrays)
+            return
+        # Read with uproot, so that the lookup does not need ROOT
+        import uproot
+        with uproot.open(filepath) as f:
+            if histogram_name not in f:
+                raise IOError(f"Could not load histogram: '{histogram_name}'")
+            self._evaluator = HistoSF2D.from_uproot(f[histogram_name])
 
     def get_jer(self, pt, eta):
+        '''
+        Relative jet energy resolution, for single jets or whole arrays of jets.
+        '''
         return self._evaluator(pt, np.abs(eta))
 
+    def export(self, path, source, digest):
+        tables.write_table(path, 'jer', source, digest, **self._evaluator.to_table())
+
+
+_htmiss_prior_cpp = '''
+#include <algorithm>
+#include <vector>
+
+namespace rebalance_prior {
+    struct Table {
+        std::vector<double> knots;
+        std::vector<std::vector<double>> values, slopes;
+    };
+    std::vector<Table> tables;
+}
+
+void rebalance_set_htmiss_prior(size_t id, const std::vector<double>& knots, const std::vector<double>& values, const std::vector<double>& slopes) {
+    using namespace rebalance_prior;
+    if (tables.size() <= id) tables.resize(id + 1);
+    Table& table = tables[id];
+    const size_t n = knots.size();
+    table.knots = knots;
+    table.values.clear();
+    table.slopes.clear();
+    for (size_t offset = 0; offset < values.size(); offset += n) {
+        table.values.emplace_back(values.begin() + offset, values.begin() + offset + n);
+        table.slopes.emplace_back(slopes.begin() + offset, slopes.begin() + offset + n);
+    }
+}
+
+double rebalance_htmiss_prior_nll(double htmiss, double bin, double id) {
+    using namespace rebalance_prior;
+    const Table& table = tables[static_cast<size_t>(id)];
+    const std::vector<double>& knots = table.knots;
+    const std::vector<double>& y = table.values[static_cast<size_t>(bin)];
+    const std::vector<double>& m = table.slopes[static_cast<size_t>(bin)];
+    const size_t n = knots.size();
+    if (htmiss <= knots[0]) return y[0];
+    if (htmiss >= knots[n-1]) return y[n-1] + m[n-1] * (htmiss - knots[n-1]);
+    const size_t i = std::upper_bound(knots.begin(), knots.end(), htmiss) - knots.begin() - 1;
+    const double dx = knots[i+1] - knots[i];
+    const double t = (htmiss - knots[i]) / dx;
+    const double t2 = t * t, t3 = t2 * t;
+    return (2*t3 - 3*t2 + 1) * y[i] + (t3 - 2*t2 + t) * dx * m[i]
+         + (-2*t3 + 3*t2) * y[i+1] + (t3 - t2) * dx * m[i+1];
+}
+'''
+
+# Lookups whose tables are loaded into the interpreter, the index is the table id
+_installed_htmiss_priors = []
+
+
+class HTMissPriorLookup():
+    '''
+    Data-driven gen HTmiss prior from the histograms in htmiss_prior.root.
+
+    There is one histogram per HT bin. Each one is normalized and turned into
+    -log(density), which is interpolated with a C1 cubic Hermite spline
+    through the bin centers. It starts flat and has a linear (i.e. exponential)
+    tail beyond the last filled bin.
+    Calling the lookup returns -log(prior) and its first two derivatives
+    with respect to htmiss, for use in batch.BatchRebalancer.
+
+    prior = HTMissPriorLookup("./input/htmiss_prior.root", year=2017)
+    keys = prior.event_keys(ht)
+    value, first, second = prior(htmiss, keys)
+    '''
+    _name_pattern = r'gen_htmiss_ht_(\d+)_to_(\d+)_(\d+)'
+    # Smallest slope of -log(prior) in the tail, per GeV
+    _minimum_tail_slope = 1e-3
+    # Derived tables, as stored by export()
+    _table_arrays = ('ht_edges', 'knots', 'values', 'slopes')
+
+    def __init__(self, filepath, year=2017):
+        if tables.is_table_directory(filepath):
+            arrays = tables.load_table(tables.table_path(filepath, tables.htmiss_prior_table_name(year)), 'htmiss_prior')
+            for name in self._table_arrays:
+                setattr(self, name, arrays[name])
+            return
+        import uproot
+        histograms = []
+        with uproot.open(filepath) as f:
+            for name in f.keys(cycle=False):
+                match = re.fullmatch(self._name_pattern, name)
+                if match and int(match.group(3)) == year:
+                    histograms.append((float(match.group(1)), float(match.group(2)), f[name]))
+            if not histograms:
+                raise IOError(f"Could not load HTmiss prior histograms for year {year} from '{filepath}'")
+            histograms.sort(key=lambda x: x[0])
+
+            edges = histograms[0][2].axis().edges()
+            contents = np.array([x[2].values() for x in histograms])
+        ht_edges = np.array([x[0] for x in histograms] + [histograms[-1][1]])
+        self._init_tables(ht_edges, edges, contents)
+
+    @classmethod
+    def from_arrays(cls, ht_edges, edges, contents):
+        '''
+        Creates the lookup from HT bin edges, HTmiss bin edges and a (nbins_ht, nbins_htmiss) content array.
+        '''
+        instance = cls.__new__(cls)
+        instance._init_tables(np.asarray(ht_edges, dtype=float), np.asarray(edges, dtype=float), np.asarray(contents, dtype=float))
+        return instance
+
+    def _init_tables(self, ht_edges, edges, contents):
+        self.ht_edges = ht_edges
+        self.knots = 0.5 * (edges[1:] + edges[:-1])
+        widths = np.diff(edges)
+        self.values = np.array([self._negative_log_density(x, widths) for x in contents])
+        self.slopes = np.array([self._spline_slopes(x) for x in self.values])
+
+    def _negative_log_density(self, contents, widths):
+        density = contents / np.sum(contents * widths)
+        filled = np.nonzero(density > 0)[0]
+        values = np.interp(np.arange(len(density)), filled, -np.log(density[filled]))
+        # Linear continuation of -log(density) after the last filled bin
+        last = filled[-1]
+        if len(filled) > 1:
+            slope = (values[last] - values[filled[-2]]) / (self.knots[last] - self.knots[filled[-2]])
+        else:
+            slope = 0.
+        slope = max(slope, self._minimum_tail_slope)
+        values[last+1:] = values[last] + slope * (self.knots[last+1:] - self.knots[last])
+        return values
+
+    def _spline_slopes(self, values):
+        slopes = np.empty_like(values)
+        slopes[1:-1] = (values[2:] - values[:-2]) / (self.knots[2:] - self.knots[:-2])
+        slopes[0] = 0.
+        slopes[-1] = max((values[-1] - values[-2]) / (self.knots[-1] - self.knots[-2]), self._minimum_tail_slope)
+        return slopes
+
+    def export(self, path, source, digest):
+        tables.write_table(path, 'htmiss_prior', source, digest, **{name : getattr(self, name) for name in self._table_arrays})
+
+    def event_keys(self, ht):
+        '''
+        Index of the HT bin to use for events with the given HT.
+        '''
+        index = np.searchsorted(self.ht_edges, ht, side='right') - 1
+        return np.clip(index, 0, len(self.ht_edges) - 2)
+
+    def __call__(self, htmiss, keys=0):
+        htmiss = np.asarray(htmiss, dtype=float)
+        keys = np.broadcast_to(keys, htmiss.shape)
+        knots = self.knots
+        y, m = self.values[keys], self.slopes[keys]
+
+        i = np.clip(np.searchsorted(knots, htmiss, side='right') - 1, 0, len(knots) - 2)
+        take = lambda a, j: np.take_along_axis(a, j[..., None], axis=-1)[..., 0]
+        dx = knots[i+1] - knots[i]
+        t = (htmiss - knots[i]) / dx
+        y0, y1, m0, m1 = take(y, i), take(y, i+1), take(m, i), take(m, i+1)
+
+        value = (2*t**3 - 3*t**2 + 1) * y0 + (t**3 - 2*t**2 + t) * dx * m0 \
+              + (-2*t**3 + 3*t**2) * y1 + (t**3 - t**2) * dx * m1
+        first = (6*t**2 - 6*t) / dx * y0 + (3*t**2 - 4*t + 1) * m0 \
+              + (-6*t**2 + 6*t) / dx * y1 + (3*t**2 - 2*t) * m1
+        second = ((12*t - 6) * y0 + (6*t - 4) * dx * m0 + (-12*t + 6) * y1 + (6*t - 2) * dx * m1) / dx**2
+
+        below = htmiss <= knots[0]
+        above = htmiss >= knots[-1]
+        value = np.where(below, y[..., 0], value)
+        value = np.where(above, y[..., -1] + m[..., -1] * (htmiss - knots[-1]), value)
+        first = np.where(below, 0., np.where(above, m[..., -1], first))
+        second = np.where(below | above, 0., second)
+        return value, first, second
+
+    def install(self):
+        '''
+        Makes the tables available to RooFit formulas as rebalance_htmiss_prior_nll(htmiss, bin, id).
+
+        The interpreter code is declared once per process, and the tables of
+        every lookup are uploaded once under their own id, which is returned.
+        Formulas of different lookups can thus be evaluated in any order.
+        '''
+        for table_id, lookup in enumerate(_installed_htmiss_priors):
+            if lookup is self:
+                return table_id
+        if not _installed_htmiss_priors:
+            r.gInterpreter.Declare(_htmiss_prior_cpp)
+        table_id = len(_installed_htmiss_priors)
+        vector = r.std.vector['double']
+        r.rebalance_set_htmiss_prior(
+            table_id,
+            vector(self.knots.tolist()),
+            vector(self.values.ravel().tolist()),
+            vector(self.slopes.ravel().tolist())
+        )
+        _installed_htmiss_priors.append(self)
+        return table_id
 
 
 class RebalanceWSFactory(NamingMixin):
     '''
     Factory class for a RooWorkspace used for rebalancing fits.
 
-    The class is initiated based on a list of jets.
+    The class is initiated based on a JetCollection or a list of jets.
 
-    jets = [Jet(pt, eta, phi) for pt, eta, phi in ...]
+    jets = JetCollection(pt, eta, phi)
     factory = RebalanceWSFactory(jets)
     factory.build()
+
+    With likelihood='sum', the NLL is built as a sum of per-jet
+    -log Gaussian terms plus the -log prior, instead of the log of
+    the product likelihood, which underflows for many jets.
+    With likelihood='compiled', the NLL calls a compiled C++ kernel
+    for the jet multiplicity, see kernels.py.
+
+    With coordinates='px_py', the gen momenta float in Cartesian
+    coordinates, so that the HTmiss components are linear sums.
+    The Gaussian of each jet then uses the full 2x2 covariance, with
+    the pt resolution along the reco jet direction and transverse_resolution
+    times the pt resolution across it. Unlike pt/phi, where gen phi is fixed
+    to reco, this lets the jet direction float by about
+    transverse_resolution * sigma_pt / pt in radians.
+
+    With a JetFreezePolicy, soft jets keep their gen momenta fixed to reco.
+
+    With warm_start=True, the floating gen momenta start from the
+    linearized least-squares solution of the model, see
+    warm_start_values(), instead of the reco values.
+
+    With prior='histogram', the gen HTmiss prior is taken from the
+    HTmiss histograms of the reco HT bin of the event, see HTMissPriorLookup.
+    The lookup has to be set with set_htmiss_prior_source() or set_htmiss_prior().
     '''
-    def __init__(self,jets):
-        self.jets = jets
-        self.njets = len(jets)
+    _likelihood_modes = ('product', 'sum', 'compiled')
+    _coordinate_modes = {
+        'pt_phi' : ('pt','phi'),
+        'px_py' : ('px','py'),
+    }
+    # Directions of the resolution variables of each jet
+    _resolution_directions = {
+        'pt_phi' : ('pt',),
+        'px_py' : ('along', 'across'),
+    }
+    _prior_modes = ('exponential', 'histogram')
+
+    def __init__(self,jets, likelihood='product', coordinates='pt_phi', prior='exponential', freeze_policy=None,
+                 warm_start=False, transverse_resolution=default_transverse_resolution):
+        if likelihood not in self._likelihood_modes:
+            raise ValueError(f"Unknown likelihood mode: '{likelihood}'")
+        if coordinates not in self._coordinate_modes:
+            raise ValueError(f"Unknown coordinates: '{coordinates}'")
+        if prior not in self._prior_modes:
+            raise ValueError(f"Unknown prior mode: '{prior}'")
+        if prior == 'histogram' and likelihood == 'compiled':
+            raise ValueError("The compiled likelihood only supports the exponential prior.")
+        self.likelihood = likelihood
+        self.coordinates = coordinates
+        self.prior = prior
+        self.freeze_policy = freeze_policy
+        self.warm_start = warm_start
+        self.transverse_resolution = transverse_resolution
+        self.jets = JetCollection.from_jets(jets)
+        self.njets = len(self.jets)
         self.ws = r.RooWorkspace()
         self._wsimp = getattr(self.ws, 'import')
         self._jer_evaluator = None
-        self._directions = 'pt','phi'
+        self._jer_values = None
+        self._instrumentation = None
+        self._minimizer = None
+        self._value_list = None
+        self._htmiss_prior = None
+        self._directions = self._coordinate_modes[coordinates]
     def set_jer_source(self,filepath, histogram_name):
-        self._jer_evaluator = JERLookup(filepath, histogram_name)
+        self.set_jer_evaluator(JERLookup(filepath, histogram_name))
+
+    def set_jer_evaluator(self, evaluator):
+        self._jer_evaluator = evaluator
+        self._jer_values = None
+
+    def set_htmiss_prior_source(self, filepath, year=2017):
+        self.set_htmiss_prior(HTMissPriorLookup(filepath, year))
+
+    def set_htmiss_prior(self, lookup):
+        '''
+        Sets the HTMissPriorLookup used with prior='histogram', which may be shared between factories.
+        '''
+        self._htmiss_prior = lookup
+
+    def get_htmiss_prior(self):
+        return self._htmiss_prior
+
+    def set_instrumentation(self, instrumentation):
+        '''
+        Records per-stage timing and object counts, see instrument.Instrumentation.
+        '''
+        self._instrumentation = instrumentation
+
+    def get_instrumentation(self):
+        return self._instrumentation
 
     def get_ws(self):
         return self.ws
 
+    def get_minimizer(self):
+        '''
+        RooMinimizer of the NLL, created once and reused for every event of this workspace.
+
+        The minimizer reads the current values and limits of the parameters at each
+        migrad() call, so it stays valid after update_jets().
+        '''
+        if self._minimizer is None:
+            self._minimizer = r.RooMinimizer(self.ws.function(self._name_negative_log_likelihood()))
+        return self._minimizer
+
+    def close(self):
+        '''
+        Releases the minimizer and the workspace with all RooFit objects it owns.
+
+        The factory holds the only references, so the C++ objects are
+        destroyed right away instead of whenever Python gets to them.
+        '''
+        self._minimizer = None
+        self._value_list = None
+        self._wsimp = None
+        self.ws = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def get_jet(self, index):
         return self.jets[index]
 
+    def _get_value_list(self):
+        '''
+        Reco momenta, gen momenta and the NLL in one RooArgList, collected by name once per workspace.
+
+        The structure of the model does not change in update_jets(), so the handles stay valid.
+        '''
+        if self._value_list is None:
+            items = []
+            for naming in (self._name_reco_momentum_var, self._name_gen_momentum_var):
+                for direction in self._directions:
+                    items.extend(self.ws.var(naming(direction, index)) for index in range(self.njets))
+            items.append(self.ws.function(self._name_negative_log_likelihood()))
+            self._value_list = make_RooArgList(items)
+        return self._value_list
+
+    def _read_momenta(self):
+        values = read_values(self._get_value_list())
+        momenta = values[:-1].reshape(2, len(self._directions), self.njets)
+        reco, gen = ({direction : x for direction, x in zip(self._directions, tier)} for tier in momenta)
+        return reco, gen, values[-1]
+
+    def extract(self):
+        '''
+        Current reco and gen momenta in both coordinate systems, HTmiss and the NLL, see WorkspaceValues.
+
+        All values are read in one call, e.g. after the fit.
+        '''
+        return WorkspaceValues.from_momenta(*self._read_momenta())
+
+    def update_jets(self, jets):
+        '''
+        Re-targets an already built workspace to a new set of jets.
+
+        Only values, limits and resolutions of the existing variables are reset,
+        the structure of the model is kept. The number of jets has to stay the same.
+        '''
+        if len(jets) != self.njets:
+            raise ValueError(f"Cannot update workspace for {self.njets} jets with {len(jets)} jets.")
+        self.jets = JetCollection.from_jets(jets)
+        self._jer_values = None
+        if self._instrumentation is None:
+            self._update_all_jets()
+        else:
+            with self._instrumentation.stage('update_jets'):
+                self._update_all_jets()
+
+    def _update_all_jets(self):
+        for index in range(self.njets):
+            for direction in self._directions:
+                self._update_single_jet_momentum_vars(direction, index)
+            for direction in self._resolution_directions[self.coordinates]:
+                resolution_var = self.ws.var(self._name_jet_resolution_var(direction, index))
+                if resolution_var:
+                    resolution_var.setVal(self._resolution(index, direction))
+        if self.prior == 'histogram':
+            self.ws.var(self._name_gen_htmiss_prior_table()).setVal(self._htmiss_prior.install())
+            self.ws.var(self._name_gen_htmiss_prior_bin()).setVal(self._htmiss_prior_bin())
+        if self.freeze_policy is not None:
+            self._freeze_jets()
+        if self.warm_start:
+            self._seed_gen_momenta()
+
     def build(self):
         '''
         Defines all ingredients for the fit model.
         '''
-        self._build_metadata()
-        self._build_all_jets()
-        self._build_combined_momentum_pdf()
-        self._build_priors()
-        self._build_likelihood()
-        self._build_negative_log_likelihood()
+        for stage in self._build_stages():
+            if self._instrumentation is None:
+                stage()
+            else:
+                with self._instrumentation.stage(stage.__name__.lstrip('_'), self.ws):
+                    stage()
+
+    def _build_stages(self):
+        '''
+        The build steps for the chosen likelihood mode, in order.
+        '''
+        if self.likelihood == 'compiled':
+            stages = [
+                self._build_metadata,
+                self._build_all_jets,
+                self._build_gen_htmiss_prior_slope,
+                self._build_negative_log_likelihood,
+            ]
+        else:
+            stages = self._build_model_stages()
+        if self.freeze_policy is not None:
+            stages.append(self._freeze_jets)
+        if self.warm_start:
+            stages.append(self._seed_gen_momenta)
+        return stages
+
+    def _build_model_stages(self):
+        stages = [self._build_metadata, self._build_all_jets]
+        if self.likelihood == 'product':
+            stages.append(self._build_combined_momentum_pdf)
+        stages.append(self._build_priors)
+        if self.likelihood == 'product':
+            stages.append(self._build_likelihood)
+        stages.append(self._build_negative_log_likelihood)
+        return stages
 
     def _build_metadata(self):
         self._build_metadata_njets()
@@ -162,6 +756,12 @@ class RebalanceWSFactory(NamingMixin):
         return "nll"
 
     def _build_negative_log_likelihood(self):
+        if self.likelihood == 'sum':
+            self._build_summed_negative_log_likelihood()
+            return
+        if self.likelihood == 'compiled':
+            self._build_compiled_negative_log_likelihood()
+            return
         likelihood_name = self._name_likelihood()
         likelihood_function = self.ws.function(likelihood_name)
         nll_name = self._name_negative_log_likelihood()
@@ -175,6 +775,131 @@ class RebalanceWSFactory(NamingMixin):
         self._wsimp(nll)
 
 
+    def _build_summed_negative_log_likelihood(self):
+        '''
+        Defines the NLL as a sum of -log terms, one per floating gen momentum plus the prior.
+        '''
+        terms = []
+        if self.coordinates == 'px_py':
+            for index in self._modelled_jets():
+                terms.append(self._build_single_jet_covariant_nll_term(index))
+        else:
+            for direction, index in self.modelled_momenta():
+                terms.append(self._build_single_jet_nll_term(direction, index))
+        terms.append(self._build_gen_htmiss_prior_nll_term())
+
+        nll_name = self._name_negative_log_likelihood()
+        nll = r.RooAddition(
+            nll_name,
+            nll_name,
+            make_RooArgList(terms)
+        )
+        self._wsimp(nll)
+
+    def kernel_arguments(self):
+        '''
+        Workspace variables in the argument order of the compiled likelihood kernel.
+        '''
+        if self.coordinates == 'px_py':
+            names = self._expand_naming(self._name_gen_momentum_var) \
+                  + self._expand_naming(self._name_reco_momentum_var) \
+                  + self._expand_naming(self._name_jet_resolution_var, directions=['along', 'across'])
+        else:
+            names = self._expand_naming(self._name_gen_momentum_var, directions=['pt']) \
+                  + self._expand_naming(self._name_reco_momentum_var, directions=['pt']) \
+                  + self._expand_naming(self._name_jet_resolution_var, directions=['pt']) \
+                  + self._expand_naming(self._name_gen_momentum_var, directions=['phi'])
+        names.append(self._name_total_gen_htmiss_prior_slope())
+        return [self.ws.var(x) for x in names]
+
+    def _build_compiled_negative_log_likelihood(self):
+        '''
+        Defines the NLL as a single call to the compiled kernel for this jet multiplicity.
+        '''
+        kernel = get_kernel(self.njets, self.coordinates)
+        arguments = self.kernel_arguments()
+        expression = f"{kernel.nll_function_name}({','.join(x.GetName() for x in arguments)})"
+        nll_name = self._name_negative_log_likelihood()
+        nll = r.RooFormulaVar(
+            nll_name,
+            expression,
+            make_RooArgList(arguments)
+        )
+        self._wsimp(nll)
+
+    def _build_single_jet_nll_term(self, direction, index):
+        '''
+        -log of the unnormalized Gaussian PDF(reco | gen) for a given direction and jet index.
+        '''
+        names = [
+            self._name_reco_momentum_var(direction, index),
+            self._name_gen_momentum_var(direction, index),
+            self._name_jet_resolution_var(direction, index),
+        ]
+        term = r.RooFormulaVar(
+            self._name_jet_nll_term(direction, index),
+            "0.5*(({}-{})/{})**2".format(*names),
+            make_RooArgList([self.ws.var(x) for x in names])
+        )
+        self._wsimp(term)
+        return self.ws.function(term.GetName())
+
+    def _jet_quadratic_form(self, index):
+        '''
+        Formula and arguments of 0.5 * chi2 of one jet in px/py, in the frame of the reco jet direction.
+        '''
+        names = [
+            self._name_reco_momentum_var('px', index),
+            self._name_reco_momentum_var('py', index),
+            self._name_gen_momentum_var('px', index),
+            self._name_gen_momentum_var('py', index),
+            self._name_jet_resolution_var('along', index),
+            self._name_jet_resolution_var('across', index),
+        ]
+        rx, ry, gx, gy, sigma_along, sigma_across = names
+        norm = f"sqrt({rx}*{rx}+{ry}*{ry})"
+        along = f"((({rx}-{gx})*{rx}+({ry}-{gy})*{ry})/{norm})"
+        across = f"((({ry}-{gy})*{rx}-({rx}-{gx})*{ry})/{norm})"
+        expression = f"0.5*(({along}/{sigma_along})**2+({across}/{sigma_across})**2)"
+        return expression, make_RooArgList([self.ws.var(x) for x in names])
+
+    def _build_single_jet_covariant_nll_term(self, index):
+        '''
+        -log of the unnormalized 2D Gaussian PDF(reco | gen) of one jet in px/py coordinates.
+        '''
+        expression, arguments = self._jet_quadratic_form(index)
+        term = r.RooFormulaVar(self._name_jet_nll_term('pxpy', index), expression, arguments)
+        self._wsimp(term)
+        return self.ws.function(term.GetName())
+
+    def _build_gen_htmiss_prior_nll_term(self):
+        '''
+        -log of the HTmiss prior, written out analytically.
+        '''
+        if self.prior == 'histogram':
+            return self._build_gen_htmiss_histogram_prior_nll_term()
+        slope_name = self._name_total_gen_htmiss_prior_slope()
+        htmiss_name = self._name_partial_gen_htmiss_variable(direction='pt')
+        term = r.RooFormulaVar(
+            self._name_prior_nll_term(),
+            f"-{slope_name}*{htmiss_name}",
+            r.RooArgList(self.ws.var(slope_name), self.ws.function(htmiss_name))
+        )
+        self._wsimp(term)
+        return self.ws.function(term.GetName())
+
+    def _build_gen_htmiss_histogram_prior_nll_term(self):
+        bin_variable = self._build_gen_htmiss_prior_bin()
+        table_variable = self.ws.var(self._name_gen_htmiss_prior_table())
+        htmiss_name = self._name_partial_gen_htmiss_variable(direction='pt')
+        term = r.RooFormulaVar(
+            self._name_prior_nll_term(),
+            f"rebalance_htmiss_prior_nll({htmiss_name},{bin_variable.GetName()},{table_variable.GetName()})",
+            r.RooArgList(self.ws.function(htmiss_name), bin_variable, table_variable)
+        )
+        self._wsimp(term)
+        return self.ws.function(term.GetName())
+
     def _build_likelihood(self):
         partial_pdf_names = [
             self._name_total_prior_pdf(),
@@ -287,6 +1012,7 @@ class RebalanceWSFactory(NamingMixin):
             expression,
             make_RooArgList(variables)
         )
+        self._wsimp(htmiss_partial_variable)
 
     def _build_derived_gen_htmiss_pt_phi_variables(self):
         '''
@@ -335,7 +1061,7 @@ class RebalanceWSFactory(NamingMixin):
     def _name_total_gen_htmiss_prior_slope(self):
         return 'gen_htmiss_prior_slope'
 
-    def _build_gen_htmiss_prior(self):
+    def _build_gen_htmiss_prior_slope(self):
         slope_name = self._name_total_gen_htmiss_prior_slope()
         slope_variable = r.RooRealVar(
             slope_name,
@@ -343,6 +1069,38 @@ class RebalanceWSFactory(NamingMixin):
             -0.05,
         )
         self._wsimp(slope_variable)
+        return self.ws.var(slope_name)
+
+    def _htmiss_prior_bin(self):
+        '''
+        Index of the prior histogram to use, chosen by the reco HT of the event.
+        '''
+        if self._htmiss_prior is None:
+            raise RuntimeError("No HTmiss prior lookup set, use set_htmiss_prior_source() or set_htmiss_prior().")
+        ht = np.sum(self.jets.pt)
+        return float(self._htmiss_prior.event_keys(ht))
+
+    def _build_gen_htmiss_prior_bin(self):
+        bin_name = self._name_gen_htmiss_prior_bin()
+        # Shared by the prior PDF and the summed NLL term
+        if self.ws.var(bin_name):
+            return self.ws.var(bin_name)
+        bin_variable = r.RooRealVar(
+            bin_name,
+            bin_name,
+            self._htmiss_prior_bin()
+        )
+        self._wsimp(bin_variable)
+        # Selects the tables of this factory's lookup, which may differ between factories
+        table_name = self._name_gen_htmiss_prior_table()
+        self._wsimp(r.RooRealVar(table_name, table_name, self._htmiss_prior.install()))
+        return self.ws.var(bin_name)
+
+    def _build_gen_htmiss_prior(self):
+        if self.prior == 'histogram':
+            self._build_gen_htmiss_histogram_prior()
+            return
+        slope_variable = self._build_gen_htmiss_prior_slope()
 
         prior_pdf_name = self._name_total_gen_htmiss_prior_pdf()
         htmiss_variable = self.ws.function(self._name_partial_gen_htmiss_variable(direction='pt'))
@@ -354,6 +1112,19 @@ class RebalanceWSFactory(NamingMixin):
         )
         self._wsimp(prior_pdf)
 
+    def _build_gen_htmiss_histogram_prior(self):
+        bin_variable = self._build_gen_htmiss_prior_bin()
+        table_variable = self.ws.var(self._name_gen_htmiss_prior_table())
+        prior_pdf_name = self._name_total_gen_htmiss_prior_pdf()
+        htmiss_variable = self.ws.function(self._name_partial_gen_htmiss_variable(direction='pt'))
+        prior_pdf = r.RooGenericPdf(
+            prior_pdf_name,
+            prior_pdf_name,
+            f"exp(-rebalance_htmiss_prior_nll({htmiss_variable.GetName()},{bin_variable.GetName()},{table_variable.GetName()}))",
+            r.RooArgList(htmiss_variable, bin_variable, table_variable)
+        )
+        self._wsimp(prior_pdf)
+
     def _build_total_prior(self):
         pdf_name = self._name_total_prior_pdf()
         partial_prior_pdf_names = [self._name_total_gen_htmiss_prior_pdf()]
@@ -373,6 +1144,121 @@ class RebalanceWSFactory(NamingMixin):
         self._build_gen_htmiss_prior()
         self._build_total_prior()
 
+    def floating_momenta(self):
+        '''
+        (direction, index) pairs of all gen momentum variables that float in the fit.
+        '''
+        floating = []
+        for index in range(self.njets):
+            for direction in self._directions:
+                if not self.ws.var(self._name_gen_momentum_var(direction, index)).isConstant():
+                    floating.append((direction, index))
+        return floating
+
+    def modelled_momenta(self):
+        '''
+        (direction, index) pairs of all gen momenta with a resolution term, including frozen ones.
+        '''
+        modelled = set(self._modelled_jets())
+        if self.coordinates == 'px_py':
+            return [(direction, index) for index in range(self.njets) for direction in self._directions if index in modelled]
+        return [(direction, index) for index in range(self.njets) for direction in self._directions
+                if self.ws.var(self._name_jet_resolution_var(direction, index))]
+
+    def _modelled_jets(self):
+        '''
+        Indices of the jets with resolution variables, i.e. with a Gaussian term.
+        '''
+        direction = self._resolution_directions[self.coordinates][0]
+        return [index for index in range(self.njets) if self.ws.var(self._name_jet_resolution_var(direction, index))]
+
+    def frozen_jets(self):
+        '''
+        Boolean mask of the jets that the freeze policy fixes to their reco values.
+        '''
+        if self.freeze_policy is None:
+            return np.zeros(self.njets, dtype=bool)
+        return self.freeze_policy.frozen(self.jets.pt)
+
+    def warm_start_values(self):
+        '''
+        Linearized least-squares estimate of the floating gen momenta.
+
+        The reco HTmiss is distributed over the floating momenta in proportion
+        to their covariances. With a prior of constant slope, the HTmiss
+        vector is reduced until the pull of the Gaussians matches the slope,
+        which for the exponential prior in pt/phi coordinates is the exact minimum.
+        Frozen and constant momenta keep their values.
+        Returns the (direction, index) pairs and the estimated values.
+        '''
+        parameters = self.floating_momenta()
+        if not parameters:
+            return parameters, np.zeros(0)
+        reco = np.array([self.jets.momentum(direction)[index] for direction, index in parameters])
+        covariance = self._parameter_covariance(parameters)
+        design = np.array([self._htmiss_derivative(direction, index) for direction, index in parameters]).T
+
+        htmiss = np.array([np.sum(self.jets.px), np.sum(self.jets.py)])
+        multiplier = _balance_multiplier(design @ covariance @ design.T, htmiss, self._htmiss_prior_strength())
+        return parameters, reco - covariance @ design.T @ multiplier
+
+    def _jet_covariance(self, index):
+        '''
+        Covariance of the momenta of one jet, in the order of the fit coordinates.
+        '''
+        if self.coordinates == 'px_py':
+            phi = self.jets.phi[index]
+            along = np.array([np.cos(phi), np.sin(phi)])
+            across = np.array([-np.sin(phi), np.cos(phi)])
+            return self._resolution(index, 'along')**2 * np.outer(along, along) \
+                 + self._resolution(index, 'across')**2 * np.outer(across, across)
+        # phi is fixed in the pt/phi model
+        return np.diag([self._resolution(index, 'pt')**2, 0.])
+
+    def _parameter_covariance(self, parameters):
+        '''
+        Block-diagonal covariance of the given (direction, index) gen momenta.
+        '''
+        covariance = np.zeros((len(parameters), len(parameters)))
+        for i, (direction, index) in enumerate(parameters):
+            jet_covariance = self._jet_covariance(index)
+            for j, (other_direction, other_index) in enumerate(parameters):
+                if other_index == index:
+                    covariance[i, j] = jet_covariance[self._directions.index(direction), self._directions.index(other_direction)]
+        return covariance
+
+    def _htmiss_prior_strength(self):
+        '''
+        Slope of -log(prior) in HTmiss, at the reco HTmiss for the histogram prior.
+        '''
+        if self.prior == 'histogram':
+            htmiss = np.hypot(np.sum(self.jets.px), np.sum(self.jets.py))
+            _, first, _ = self._htmiss_prior(htmiss, int(self._htmiss_prior_bin()))
+            return max(float(first), 0.)
+        return -self.ws.var(self._name_total_gen_htmiss_prior_slope()).getVal()
+
+    def _seed_gen_momenta(self):
+        parameters, values = self.warm_start_values()
+        for (direction, index), value in zip(parameters, values):
+            gen_var = self.ws.var(self._name_gen_momentum_var(direction, index))
+            gen_var.setVal(float(np.clip(value, gen_var.getMin(), gen_var.getMax())))
+
+    def _freeze_jets(self):
+        frozen = self.frozen_jets()
+        for direction, index in self.modelled_momenta():
+            self.ws.var(self._name_gen_momentum_var(direction, index)).setConstant(bool(frozen[index]))
+
+    def _htmiss_derivative(self, direction, index):
+        '''
+        Derivative of the gen HTmiss x and y components with respect to a gen momentum variable.
+        '''
+        if direction == 'px':
+            return (1., 0.)
+        if direction == 'py':
+            return (0., 1.)
+        phi = self.ws.var(self._name_gen_momentum_var('phi', index)).getVal()
+        return (np.cos(phi), np.sin(phi))
+
     def _build_all_jets(self):
         '''
         Defines gen->reco PDFs for all jets.
@@ -401,9 +1287,7 @@ class RebalanceWSFactory(NamingMixin):
         '''
         Defines RooRealVars for gen and reco momenta for a given momentum direction and jet index.
         '''
-        jet = self.get_jet(index)
-
-        central_value = getattr(jet, direction)
+        central_value = float(self.jets.momentum(direction)[index])
 
         args = [central_value]
 
@@ -434,23 +1318,80 @@ class RebalanceWSFactory(NamingMixin):
 
         return (gen_var, reco_var)
 
+    def _update_single_jet_momentum_vars(self, direction, index):
+        '''
+        Resets gen and reco momentum variables and the resolution for a given direction and jet index.
+        '''
+        central_value = float(self.jets.momentum(direction)[index])
+
+        gen_var = self.ws.var(self._name_gen_momentum_var(direction, index))
+        limits = self._variable_limits(direction, central_value)
+        if not any([x is None for x in limits]):
+            gen_var.setRange(*limits)
+        gen_var.setVal(central_value)
+        gen_var.setError(0)
+
+        reco_var = self.ws.var(self._name_reco_momentum_var(direction, index))
+        reco_var.setVal(central_value)
+
     def _resolution(self, index, direction):
         '''
         The jet resolution in a given direction for given jet index in GeV.
+
+        Besides the momentum directions, 'along' and 'across' give the
+        resolution along and perpendicular to the reco jet direction.
+        '''
+        if direction == 'along':
+            return self._resolution(index, 'pt')
+        if direction == 'across':
+            return self._transverse_resolution(index)
+
+        sigma = self._relative_resolutions()[index]
+
+        return sigma * self.jets.momentum(direction)[index]
+
+    def _transverse_resolution(self, index):
         '''
-        jet = self.get_jet(index)
-        sigma = self._jer_evaluator.get_jer(jet.pt, jet.eta)
+        The jet resolution perpendicular to the jet direction in GeV, see default_transverse_resolution.
+        '''
+        return self.transverse_resolution * self._resolution(index, 'pt')
 
-        return sigma * getattr(jet, direction)
+    def _relative_resolutions(self):
+        '''
+        Relative resolutions of all jets, looked up once per event.
+        '''
+        if self._jer_values is None:
+            self._jer_values = self._jer_evaluator.get_jer(self.jets.pt, self.jets.eta)
+        return self._jer_values
 
     def _build_single_jet(self, index):
         '''
         Defines variables and PDFs for a single jet index.
         '''
+        if self.coordinates == 'px_py':
+            gen_vars = [self._build_single_jet_momentum_vars(direction, index)[0] for direction in self._directions]
+            if not all(var.isConstant() for var in gen_vars):
+                self._build_single_jet_covariant_pdf(index)
+            return
         for direction in self._directions:
             gen_var, reco_var = self._build_single_jet_momentum_vars(direction, index)
             self._build_single_jet_momentum_pdf(gen_var, reco_var, direction, index)
 
+    def _build_single_jet_covariant_pdf(self, index):
+        '''
+        Defines the 2D Gaussian PDF(reco | gen) of one jet in px/py, with the full covariance.
+
+        The Gaussian factorizes along and across the reco jet direction, which
+        keeps the model independent of the orientation of the event.
+        '''
+        for direction in self._resolution_directions['px_py']:
+            resolution_name = self._name_jet_resolution_var(direction, index)
+            self._wsimp(r.RooRealVar(resolution_name, resolution_name, self._resolution(index, direction)))
+        expression, arguments = self._jet_quadratic_form(index)
+        pdf_name = self._name_jet_momentum_pdf('pxpy', index)
+        momentum_pdf = r.RooGenericPdf(pdf_name, pdf_name, f"exp(-{expression})", arguments)
+        self._wsimp(momentum_pdf)
+
     def _build_single_jet_momentum_pdf(self, gen_var, reco_var, direction, index):
         '''
         Defines the PDF(reco | gen), i.e. the probability representing the agreement
@@ -485,7 +1426,8 @@ class RebalanceWSFactory(NamingMixin):
         '''
         Defines the product PDF of all individual jet PDFs.
         '''
-        individual_pdf_names = self._expand_naming(self._name_jet_momentum_pdf)
+        directions = ['pxpy'] if self.coordinates == 'px_py' else None
+        individual_pdf_names = self._expand_naming(self._name_jet_momentum_pdf, directions=directions)
 
         individual_pdfs, expression_parts = [], []
         for name in individual_pdf_names:
@@ -505,3 +1447,107 @@ class RebalanceWSFactory(NamingMixin):
                     )
 
         self._wsimp(combined_pdf)
+
+
+class RebalanceWSCache():
+    '''
+    Bounded cache of built workspace templates, one per jet multiplicity.
+
+    The first event with a given number of jets builds the workspace,
+    later events only update the values of the existing variables.
+    The least recently used template is evicted once max_size is reached.
+
+    cache = RebalanceWSCache(jer_source=("./input/jer.root", "jer_data"))
+    factory = cache.get(jets)
+    ws = factory.get_ws()
+
+    The JER and HTmiss prior lookups are loaded once and shared by all templates.
+    Evicted templates are closed right away. If max_rss_mb is set, the resident
+    memory is checked every check_interval events and all templates are
+    released once it is exceeded. If that does not bring the memory under
+    the budget, the cache stops clearing and over_budget() reports that the
+    process should be replaced.
+    '''
+    def __init__(self, max_size=32, jer_source=None, factory_class=RebalanceWSFactory, instrumentation=None,
+                 htmiss_prior_source=None, max_rss_mb=None, check_interval=100, **factory_kwargs):
+        self.max_size = max_size
+        self.max_rss_mb = max_rss_mb
+        self.check_interval = check_interval
+        self.cleanups = 0
+        self._nevents = 0
+        # The last clear did not bring the memory under the budget
+        self._exhausted = False
+        self._instrumentation = instrumentation
+        self._factory_kwargs = factory_kwargs
+        self._jer_evaluator = JERLookup(*jer_source) if jer_source is not None else None
+        self._htmiss_prior = HTMissPriorLookup(*htmiss_prior_source) if htmiss_prior_source is not None else None
+        self._factory_class = factory_class
+        self._templates = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, jets):
+        return (len(jets), self._factory_kwargs.get('coordinates', 'pt_phi'))
+
+    def _create(self, jets):
+        factory = self._factory_class(jets, **self._factory_kwargs)
+        if self._jer_evaluator is not None:
+            factory.set_jer_evaluator(self._jer_evaluator)
+        if self._htmiss_prior is not None:
+            factory.set_htmiss_prior(self._htmiss_prior)
+        factory.set_instrumentation(self._instrumentation)
+        factory.build()
+        return factory
+
+    def get(self, jets):
+        '''
+        Returns a built factory whose workspace describes the given jets.
+        '''
+        self._nevents += 1
+        if self.max_rss_mb is not None and self._nevents % self.check_interval == 0:
+            self._enforce_memory_budget()
+        key = self._key(jets)
+        factory = self._templates.get(key)
+        if factory is None:
+            self.misses += 1
+            factory = self._create(jets)
+            self._templates[key] = factory
+            if len(self._templates) > self.max_size:
+                _, evicted = self._templates.popitem(last=False)
+                evicted.close()
+        else:
+            self.hits += 1
+            self._templates.move_to_end(key)
+            factory.update_jets(jets)
+        return factory
+
+    def _enforce_memory_budget(self):
+        from instrument import current_rss_mb
+        rss = current_rss_mb()
+        if self._instrumentation is not None:
+            self._instrumentation.record('rss_mb', rss)
+        if rss <= self.max_rss_mb:
+            self._exhausted = False
+        elif not self._exhausted:
+            # Clearing again would only rebuild the same templates
+            self.clear()
+            gc.collect()
+            self.cleanups += 1
+            self._exhausted = current_rss_mb() > self.max_rss_mb
+
+    def over_budget(self):
+        '''
+        True if memory stays above the budget after releasing all templates, i.e. the process should be recycled.
+        '''
+        if self.max_rss_mb is None:
+            return False
+        self._enforce_memory_budget()
+        return self._exhausted
+
+    def clear(self):
+        for factory in self._templates.values():
+            factory.close()
+        self._templates.clear()
+
+    def __len__(self):
+        return len(self._templates)
@@ -0,0 +1,277 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import asdict, dataclass, field
+import uproot
+import parallel
+
+
+@dataclass
+class Shard():
+    '''
+    A contiguous entry range of one input file, processed and checkpointed as a unit.
+    '''
+    index: int
+    filepath: str
+    entry_start: int
+    entry_stop: int
+
+    @property
+    def name(self):
+        return f"shard_{self.index:05d}"
+
+
+@dataclass
+class ShardCheckpoint():
+    '''
+    Progress of one shard: all entries before committed_stop are written to the listed parts.
+    '''
+    committed_stop: int
+    parts: list = field(default_factory=list)
+    done: bool = False
+    wall_time: float = 0.
+
+
+def shard_configuration(jer_source=("./input/jer.root", "jer_data"), htmiss_prior_file=None, year=2017, fit_engine=None,
+                        significance_threshold=None):
+    '''
+    Fit settings of a sharded job, as stored in its manifest.
+
+    All shards of a job run with these settings, so that the merged output
+    does not mix results of different fits.
+    '''
+    jer_file, jer_histogram = jer_source
+    return {
+        'jer_source' : [os.path.abspath(jer_file), jer_histogram],
+        'htmiss_prior_file' : os.path.abspath(htmiss_prior_file) if htmiss_prior_file is not None else None,
+        'year' : year,
+        'fit_engine' : fit_engine,
+        'significance_threshold' : significance_threshold,
+    }
+
+
+def _write_json(path, content):
+    # Write and rename, so that a crash never leaves a truncated file behind
+    with open(path + '.tmp', 'w') as f:
+        json.dump(content, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+class ShardManifest():
+    '''
+    Plan of a sharded rebalancing job plus the progress of every shard.
+
+    The manifest file lists the shards and the job configuration, including
+    the fit settings of shard_configuration(), and is written once by plan().
+    Each shard keeps its own checkpoint file
+    in the output directory, so that shards can run as independent
+    processes or batch jobs without writing to a shared file.
+
+    manifest = ShardManifest.plan(["tree_22.root"], "job/manifest.json", shard_size=100000,
+                                  fit=shard_configuration(htmiss_prior_file="./input/htmiss_prior.root"))
+    manifest = ShardManifest.load("job/manifest.json")
+    manifest.pending()
+    '''
+    def __init__(self, path, shards, config):
+        self.path = path
+        self.shards = shards
+        self.config = config
+
+    @property
+    def output_dir(self):
+        return os.path.join(os.path.dirname(os.path.abspath(self.path)), self.config['output_dir'])
+
+    def shard_configuration(self):
+        if 'fit' not in self.config:
+            raise RuntimeError(f"Manifest '{self.path}' has no fit configuration, plan the job again.")
+        return self.config['fit']
+
+    @classmethod
+    def plan(cls, files, path, shard_size=100000, treename='Events', output_dir='shards', fit=None, **config):
+        shards = []
+        for filepath in files:
+            with uproot.open(filepath) as f:
+                nentries = f[treename].num_entries
+            for start in range(0, nentries, shard_size):
+                shards.append(Shard(len(shards), os.path.abspath(filepath), start, min(start + shard_size, nentries)))
+        fit = fit if fit is not None else shard_configuration()
+        config = {'treename' : treename, 'output_dir' : output_dir, 'shard_size' : shard_size, 'fit' : fit, **config}
+        manifest = cls(path, shards, config)
+        os.makedirs(manifest.output_dir, exist_ok=True)
+        _write_json(path, {'config' : config, 'shards' : [asdict(x) for x in shards]})
+        return manifest
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            content = json.load(f)
+        return cls(path, [Shard(**x) for x in content['shards']], content['config'])
+
+    def _checkpoint_path(self, shard):
+        return os.path.join(self.output_dir, f"{shard.name}.json")
+
+    def checkpoint(self, shard):
+        path = self._checkpoint_path(shard)
+        if not os.path.exists(path):
+            return ShardCheckpoint(committed_stop=shard.entry_start)
+        with open(path) as f:
+            return ShardCheckpoint(**json.load(f))
+
+    def commit(self, shard, checkpoint):
+        _write_json(self._checkpoint_path(shard), asdict(checkpoint))
+
+    def part_path(self, shard, entry_start):
+        return os.path.join(self.output_dir, shard.name, f"part_{entry_start:012d}.root")
+
+    def pending(self):
+        return [shard for shard in self.shards if not self.checkpoint(shard).done]
+
+    def status(self):
+        lines = []
+        for shard in self.shards:
+            checkpoint = self.checkpoint(shard)
+            state = 'done' if checkpoint.done else f"{checkpoint.committed_stop - shard.entry_start}/{shard.entry_stop - shard.entry_start}"
+            lines.append(f"{shard.name} {os.path.basename(shard.filepath)} [{shard.entry_start}, {shard.entry_stop}): {state}")
+        return '\n'.join(lines)
+
+
+def _init_shard_worker(fit, cache_size):
+    if 'cache' in parallel._worker:
+        if parallel._worker.get('shard_fit') != fit:
+            raise RuntimeError("Worker was initialized with a different fit configuration.")
+        return
+    htmiss_prior_source = (fit['htmiss_prior_file'], fit['year']) if fit['htmiss_prior_file'] is not None else None
+    parallel._init_worker(tuple(fit['jer_source']), cache_size, htmiss_prior_source,
+                          fit_engine=fit['fit_engine'], significance_threshold=fit['significance_threshold'])
+    parallel._worker['shard_fit'] = fit
+
+
+def run_shard(manifest_path, index, batch_size=1000, cache_size=32, fit=None):
+    '''
+    Processes one shard from its last checkpoint, committing after every batch.
+
+    Each batch is written to its own part file before the checkpoint moves
+    on, so an interrupted shard resumes at the first uncommitted batch.
+    The fit settings are taken from the manifest. If fit is given, the
+    shard only runs if it matches them.
+    '''
+    from writer import FitResultWriter
+    manifest = ShardManifest.load(manifest_path)
+    planned = manifest.shard_configuration()
+    if fit is not None and fit != planned:
+        different = sorted(key for key in set(fit) | set(planned) if fit.get(key) != planned.get(key))
+        raise ValueError(f"Fit configuration differs from the manifest in {', '.join(different)}.")
+    shard = manifest.shards[index]
+    checkpoint = manifest.checkpoint(shard)
+    if checkpoint.done:
+        return checkpoint
+    _init_shard_worker(planned, cache_size)
+
+    os.makedirs(os.path.join(manifest.output_dir, shard.name), exist_ok=True)
+    for start in range(checkpoint.committed_stop, shard.entry_stop, batch_size):
+        stop = min(start + batch_size, shard.entry_stop)
+        result = parallel._process_range(shard.filepath, manifest.config['treename'], start, stop, batch_size)
+        part = manifest.part_path(shard, start)
+        if result.events:
+            with FitResultWriter(part) as writer:
+                writer.fill_many(result.events)
+            checkpoint.parts.append(os.path.relpath(part, manifest.output_dir))
+        checkpoint.committed_stop = stop
+        checkpoint.wall_time += result.wall_time
+        manifest.commit(shard, checkpoint)
+
+    checkpoint.done = True
+    manifest.commit(shard, checkpoint)
+    return checkpoint
+
+
+def run_pending(manifest_path, indices=None, nworkers=1, **kwargs):
+    '''
+    Runs all unfinished shards, or the unfinished ones among indices, in local worker processes.
+    '''
+    manifest = ShardManifest.load(manifest_path)
+    pending = [shard.index for shard in manifest.pending() if indices is None or shard.index in indices]
+    if nworkers == 1:
+        return [run_shard(manifest_path, index, **kwargs) for index in pending]
+    with ProcessPoolExecutor(max_workers=nworkers, mp_context=mp.get_context('spawn')) as pool:
+        futures = [pool.submit(run_shard, manifest_path, index, **kwargs) for index in pending]
+        return [future.result() for future in as_completed(futures)]
+
+
+def merge(manifest_path, output, treename='Rebalanced'):
+    '''
+    Concatenates the parts of all shards in entry order into one output file.
+    '''
+    from writer import FitResultWriter
+    manifest = ShardManifest.load(manifest_path)
+    pending = manifest.pending()
+    if pending:
+        raise RuntimeError(f"Cannot merge, {len(pending)} shards are not finished.")
+    with FitResultWriter(output, treename=treename) as writer:
+        for shard in manifest.shards:
+            for part in manifest.checkpoint(shard).parts:
+                path = os.path.join(manifest.output_dir, part)
+                for arrays in uproot.iterate(f"{path}:{treename}", filter_name=lambda name: name != 'njets'):
+                    writer.extend({name : arrays[name] for name in arrays.fields})
+    return writer.nevents
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resumable, sharded rebalancing.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    plan_parser = subparsers.add_parser('plan', help="Split the inputs into shards and write the manifest")
+    plan_parser.add_argument('files', nargs='+')
+    plan_parser.add_argument('--manifest', default='manifest.json')
+    plan_parser.add_argument('--shard-size', type=int, default=100000)
+    plan_parser.add_argument('--treename', default='Events')
+    plan_parser.add_argument('--jer', default='./input/jer.root', help="JER file, or a directory written by tables.py")
+    plan_parser.add_argument('--htmiss-prior', default=None, help="Use the histogram HTmiss prior from this file or tables directory")
+    plan_parser.add_argument('--year', type=int, default=2017)
+    plan_parser.add_argument('--adaptive', action='store_true', help="Escalate the Migrad strategy only for events that need it")
+    plan_parser.add_argument('--max-calls', type=int, default=None, help="NLL evaluations per event with --adaptive")
+    plan_parser.add_argument('--timeout', type=float, default=None, help="Seconds per event with --adaptive")
+    plan_parser.add_argument('--significance-threshold', type=float, default=None,
+                             help="Skip the fit for events with a smaller reco HTmiss significance")
+
+    run_parser = subparsers.add_parser('run', help="Process unfinished shards")
+    run_parser.add_argument('--manifest', default='manifest.json')
+    run_parser.add_argument('--shard', type=int, nargs='*', default=None, help="Only these shards, e.g. one per batch job")
+    run_parser.add_argument('--nworkers', type=int, default=1)
+    run_parser.add_argument('--batch-size', type=int, default=1000)
+
+    merge_parser = subparsers.add_parser('merge', help="Merge the output of all shards")
+    merge_parser.add_argument('--manifest', default='manifest.json')
+    merge_parser.add_argument('--output', default='rebalanced.root')
+
+    status_parser = subparsers.add_parser('status')
+    status_parser.add_argument('--manifest', default='manifest.json')
+    args = parser.parse_args()
+
+    if args.command == 'plan':
+        fit = shard_configuration(
+            jer_source=(args.jer, 'jer_data'),
+            htmiss_prior_file=args.htmiss_prior,
+            year=args.year,
+            fit_engine={'max_calls' : args.max_calls, 'timeout' : args.timeout} if args.adaptive else None,
+            significance_threshold=args.significance_threshold
+        )
+        manifest = ShardManifest.plan(args.files, args.manifest, shard_size=args.shard_size, treename=args.treename, fit=fit)
+        print(f"{len(manifest.shards)} shards")
+    elif args.command == 'run':
+        # Fails early for manifests planned without fit settings
+        ShardManifest.load(args.manifest).shard_configuration()
+        start = time.perf_counter()
+        done = run_pending(args.manifest, indices=args.shard, nworkers=args.nworkers, batch_size=args.batch_size)
+        print(f"{len(done)} shards finished in {time.perf_counter() - start:.1f} s")
+    elif args.command == 'merge':
+        print(f"{merge(args.manifest, args.output)} events merged into {args.output}")
+    else:
+        print(ShardManifest.load(args.manifest).status())
+
+
+if __name__ == "__main__":
+    main()
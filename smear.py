@@ -0,0 +1,210 @@
+import argparse
+from dataclasses import dataclass
+import awkward as ak
+import numpy as np
+import uproot
+from reader import JetChunk
+from rebalance import JERLookup
+
+
+@dataclass
+class SmearedEvents():
+    '''
+    Smeared replicas stored as padded (nevents * nreplicas, max_njets) arrays.
+    '''
+    event: np.ndarray
+    replica: np.ndarray
+    pt: np.ndarray
+    eta: np.ndarray
+    phi: np.ndarray
+    mask: np.ndarray
+    ht: np.ndarray
+    htmiss_pt: np.ndarray
+    htmiss_phi: np.ndarray
+
+    def __len__(self):
+        return len(self.event)
+
+    def to_arrays(self):
+        '''
+        Columnar representation with jagged jet branches, as written to disk.
+        '''
+        counts = self.mask.sum(axis=1)
+        arrays = {
+            'event' : self.event,
+            'replica' : self.replica,
+            'ht' : self.ht,
+            'htmiss_pt' : self.htmiss_pt,
+            'htmiss_phi' : self.htmiss_phi,
+        }
+        for name in ('pt', 'eta', 'phi'):
+            arrays[f'Jet_{name}'] = ak.unflatten(getattr(self, name)[self.mask], counts)
+        return arrays
+
+
+class JetSmearer():
+    '''
+    Draws smeared replicas of rebalanced gen-level events.
+
+    Every jet pt is smeared with a Gaussian whose relative width
+    is the JER at the gen-level jet pt and eta. Replicas are generated
+    for a whole chunk of events at once.
+
+    smearer = JetSmearer(nreplicas=100, seed=42)
+    smearer.set_jer_source("./input/jer.root", "jer_data")
+    smeared = smearer.smear(gen_pt, eta, gen_phi, mask, rng=smearer.rng(stream=entry_start))
+
+    The gen momenta come from a batch.BatchFitResult with smear_result(),
+    or from the output of FitResultWriter with read_rebalanced().
+    '''
+    def __init__(self, nreplicas=100, seed=0, jet_pt_min=0.):
+        self.nreplicas = nreplicas
+        self.seed = seed
+        self.jet_pt_min = jet_pt_min
+        self._jer_evaluator = None
+
+    def set_jer_source(self, filepath, histogram_name):
+        self._jer_evaluator = JERLookup(filepath, histogram_name)
+
+    def set_jer_evaluator(self, evaluator):
+        self._jer_evaluator = evaluator
+
+    def rng(self, stream=0):
+        '''
+        Independent, reproducible random generator for a given stream.
+
+        Using e.g. the first entry of a chunk as stream makes the output
+        independent of how chunks are distributed over workers.
+        '''
+        sequence = np.random.SeedSequence(self.seed, spawn_key=(stream,))
+        return np.random.Generator(np.random.PCG64(sequence))
+
+    def smear(self, pt, eta, phi, mask, rng=None, event_offset=0, event_ids=None):
+        '''
+        Returns nreplicas smeared copies of every event in the padded input arrays.
+
+        Replicas are labeled with event_ids, e.g. the input entries, or
+        else with the event index plus event_offset.
+        '''
+        if rng is None:
+            rng = self.rng(event_offset)
+        pt, eta, phi = (np.asarray(x, dtype=float) for x in (pt, eta, phi))
+        mask = np.asarray(mask, dtype=bool)
+        nevents, njets = pt.shape
+
+        sigma = np.where(mask, self._jer_evaluator.get_jer(pt, eta), 0.)
+        noise = rng.standard_normal((nevents, self.nreplicas, njets))
+        smeared = pt[:, None, :] * (1 + sigma[:, None, :] * noise)
+        smeared = np.where(mask[:, None, :], np.maximum(smeared, 0.), 0.)
+
+        counted = mask[:, None, :] & (smeared > self.jet_pt_min)
+        ht = np.sum(smeared, axis=2, where=counted)
+        htmiss_x = -np.sum(smeared * np.cos(phi)[:, None, :], axis=2, where=counted)
+        htmiss_y = -np.sum(smeared * np.sin(phi)[:, None, :], axis=2, where=counted)
+
+        nrows = nevents * self.nreplicas
+        repeat = lambda x: np.repeat(x, self.nreplicas, axis=0)
+        if event_ids is None:
+            event_ids = np.arange(nevents) + event_offset
+        return SmearedEvents(
+            event=repeat(np.asarray(event_ids)),
+            replica=np.tile(np.arange(self.nreplicas), nevents),
+            pt=smeared.reshape(nrows, njets),
+            eta=repeat(eta),
+            phi=repeat(phi),
+            mask=repeat(mask),
+            ht=ht.reshape(nrows),
+            htmiss_pt=np.hypot(htmiss_x, htmiss_y).reshape(nrows),
+            htmiss_phi=np.arctan2(htmiss_y, htmiss_x).reshape(nrows),
+        )
+
+    def smear_result(self, result, eta, rng=None, event_offset=0):
+        '''
+        Smeared replicas of the gen jets of a batch.BatchFitResult, eta as passed to the fit.
+        '''
+        return self.smear(result.gen_pt, eta, result.gen_phi, result.mask, rng=rng, event_offset=event_offset)
+
+
+def read_rebalanced(filepath, treename='Rebalanced', step_size=10000, converged_only=False):
+    '''
+    Reads the gen jets of a FitResultWriter output, for JetSmearer.smear().
+
+    Yields a reader.JetChunk with gen pt, reco eta and gen phi and the
+    input entries of its events. Outputs of px/py fits are converted to pt
+    and phi. With converged_only, events with a fit status other than 0 are skipped.
+    '''
+    tree = uproot.open(filepath)[treename]
+    cartesian = 'gen_pt' not in tree.keys()
+    branches = ['entry', 'status', 'reco_eta'] + (['gen_px', 'gen_py'] if cartesian else ['gen_pt', 'gen_phi'])
+    for arrays, report in tree.iterate(branches, step_size=step_size, report=True):
+        if cartesian:
+            pt, phi = np.hypot(arrays['gen_px'], arrays['gen_py']), np.arctan2(arrays['gen_py'], arrays['gen_px'])
+        else:
+            pt, phi = arrays['gen_pt'], arrays['gen_phi']
+        eta, entries = arrays['reco_eta'], arrays['entry']
+        if converged_only:
+            selected = arrays['status'] == 0
+            pt, eta, phi, entries = pt[selected], eta[selected], phi[selected], entries[selected]
+        yield JetChunk(entry_start=report.tree_entry_start, pt=pt, eta=eta, phi=phi), ak.to_numpy(entries)
+
+
+class SmearedEventWriter():
+    '''
+    Appends smeared replicas to a single ROOT tree via uproot.
+
+    with SmearedEventWriter("smeared.root") as writer:
+        writer.write(smeared)
+    '''
+    def __init__(self, filepath, treename='Smeared'):
+        self.filepath = filepath
+        self.treename = treename
+        self._file = uproot.recreate(filepath)
+        self._tree = None
+
+    def write(self, smeared):
+        arrays = smeared.to_arrays()
+        if self._tree is None:
+            branch_types = {name : (values.type.content if isinstance(values, ak.Array) else values.dtype)
+                            for name, values in arrays.items()}
+            self._tree = self._file.mktree(self.treename, branch_types, counter_name=lambda counted: 'nJet')
+        self._tree.extend(arrays)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smear the rebalanced gen jets into replicas of the event.")
+    parser.add_argument('input', help="Output of exec.py, parallel.py or shards.py merge")
+    parser.add_argument('--output', default='smeared.root')
+    parser.add_argument('--treename', default='Rebalanced')
+    parser.add_argument('--jer', default='./input/jer.root', help="JER file, or a directory written by tables.py")
+    parser.add_argument('--nreplicas', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--jet-pt-min', type=float, default=0.)
+    parser.add_argument('--converged-only', action='store_true', help="Skip events whose fit did not converge")
+    parser.add_argument('--step-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    smearer = JetSmearer(nreplicas=args.nreplicas, seed=args.seed, jet_pt_min=args.jet_pt_min)
+    smearer.set_jer_source(args.jer, 'jer_data')
+    nevents = 0
+    with SmearedEventWriter(args.output) as writer:
+        for chunk, entries in read_rebalanced(args.input, args.treename, args.step_size, args.converged_only):
+            if not len(chunk):
+                continue
+            pt, eta, phi, mask = chunk.padded()
+            # One random stream per input chunk, reproducible for the same step size
+            writer.write(smearer.smear(pt, eta, phi, mask, rng=smearer.rng(stream=chunk.entry_start), event_ids=entries))
+            nevents += len(chunk)
+    print(f"{nevents} events smeared into {nevents * args.nreplicas} replicas in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
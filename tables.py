@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+import numpy as np
+
+# Description of the arrays of one table, written next to them
+_metadata_name = 'table.json'
+
+
+def table_path(directory, name):
+    return os.path.join(directory, str(name))
+
+
+def htmiss_prior_table_name(year):
+    return f"htmiss_prior_{year}"
+
+
+def is_table_directory(path):
+    '''
+    True if path is a directory written by export_tables(), instead of a ROOT file.
+    '''
+    return os.path.isdir(path)
+
+
+def write_table(path, kind, source, digest, **arrays):
+    os.makedirs(path, exist_ok=True)
+    for name, values in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(values, dtype=np.float64))
+    metadata = {'kind' : kind, 'source' : os.path.abspath(source), 'digest' : digest, 'arrays' : sorted(arrays)}
+    # Written last, so a table without metadata is known to be incomplete
+    with open(os.path.join(path, _metadata_name + '.tmp'), 'w') as f:
+        json.dump(metadata, f, indent=1)
+    os.replace(os.path.join(path, _metadata_name + '.tmp'), os.path.join(path, _metadata_name))
+
+
+def table_metadata(path):
+    metadata_path = os.path.join(path, _metadata_name)
+    if not os.path.exists(metadata_path):
+        raise IOError(f"No lookup table in '{path}', run tables.py first")
+    with open(metadata_path) as f:
+        return json.load(f)
+
+
+def load_table(path, kind):
+    '''
+    Arrays of an exported table, memory-mapped read-only.
+
+    All processes that load the same table share one copy in the page cache.
+    '''
+    metadata = table_metadata(path)
+    if metadata['kind'] != kind:
+        raise IOError(f"Table in '{path}' holds '{metadata['kind']}', not '{kind}'")
+    return {name : np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in metadata['arrays']}
+
+
+def export_tables(directory, jer_source=("./input/jer.root", "jer_data"), htmiss_prior_file=None, years=(2017,)):
+    '''
+    Converts the JER histogram and the HTmiss prior histograms into memory-mappable tables.
+
+    The tables hold everything the lookups derive from the histograms, i.e. the
+    clamp bounds of the JER lookup and the spline tables of the prior. Pass the
+    directory instead of the ROOT file to JERLookup, HTMissPriorLookup or any
+    jer_source and htmiss_prior_source argument.
+
+    export_tables("./tables", ("./input/jer.root", "jer_data"), "./input/htmiss_prior.root", years=(2017, 2018))
+    JERLookup("./tables", "jer_data")
+    '''
+    from cache import _file_digest
+    from rebalance import HTMissPriorLookup, JERLookup
+    jer_file, jer_histogram = jer_source
+    # All lookups are loaded first, so a missing histogram or year leaves no partial directory
+    lookups = [(JERLookup(jer_file, jer_histogram), table_path(directory, jer_histogram), jer_file)]
+    if htmiss_prior_file is not None:
+        for year in years:
+            lookups.append((HTMissPriorLookup(htmiss_prior_file, year), table_path(directory, htmiss_prior_table_name(year)),
+                            htmiss_prior_file))
+    digests = {source : _file_digest(source) for _, _, source in lookups}
+    for lookup, path, source in lookups:
+        lookup.export(path, source, digests[source])
+    return [path for _, path, _ in lookups]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the lookup histograms into memory-mappable tables.")
+    parser.add_argument('--output', default='tables')
+    parser.add_argument('--jer', default='./input/jer.root')
+    parser.add_argument('--jer-histogram', default='jer_data')
+    parser.add_argument('--htmiss-prior', default=None)
+    parser.add_argument('--years', type=int, nargs='+', default=[2017])
+    args = parser.parse_args()
+
+    for path in export_tables(args.output, (args.jer, args.jer_histogram), args.htmiss_prior, args.years):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
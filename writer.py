@@ -0,0 +1,117 @@
+import os
+import awkward as ak
+import numpy as np
+import uproot
+
+
+class FitResultWriter():
+    '''
+    Buffered, columnar output of per-event fit results.
+
+    Every call to fill() adds one event. Scalar values become one branch each,
+    lists (e.g. per-jet kinematics) become jagged branches that share the
+    'njets' counter. Events are written in batches of buffer_size to a single
+    ROOT tree via uproot, or to Parquet if the file name ends in '.parquet'.
+
+    with FitResultWriter("rebalanced.root") as writer:
+        writer.fill(entry=0, reco_pt=[...], gen_pt=[...], nll=1.2, status=0)
+    '''
+    def __init__(self, filepath, treename='Rebalanced', buffer_size=10000):
+        self.filepath = filepath
+        self.treename = treename
+        self.buffer_size = buffer_size
+        self.parquet = os.path.splitext(filepath)[1] == '.parquet'
+        self._rows = []
+        self._file = None
+        self._tree = None
+        self.nevents = 0
+
+    def fill(self, **values):
+        self._rows.append(values)
+        if len(self._rows) >= self.buffer_size:
+            self.flush()
+
+    def fill_many(self, events):
+        for values in events:
+            self.fill(**values)
+
+    def fill_arrays(self, mask=None, **columns):
+        '''
+        Adds many events at once from arrays.
+
+        Padded (nevents, max_njets) arrays are turned into jagged branches
+        using the jet mask, 1D arrays become scalar branches.
+        '''
+        self.flush()
+        arrays = {}
+        for name, values in columns.items():
+            values = np.asarray(values)
+            if values.ndim == 2:
+                arrays[name] = ak.unflatten(values[mask], mask.sum(axis=1))
+            else:
+                arrays[name] = values
+        self._write(arrays)
+
+    def extend(self, arrays):
+        '''
+        Adds many events at once from columnar arrays, e.g. as read back from an earlier output.
+        '''
+        self.flush()
+        columns = {}
+        for name, values in arrays.items():
+            if isinstance(values, ak.Array) and values.ndim == 1:
+                values = ak.to_numpy(values)
+            columns[name] = values
+        self._write(columns)
+
+    def _columns(self, rows):
+        arrays = {}
+        for name in rows[0]:
+            values = [row[name] for row in rows]
+            if np.ndim(values[0]) > 0:
+                arrays[name] = ak.Array([np.asarray(x, dtype=float) for x in values])
+            else:
+                arrays[name] = np.asarray(values)
+        return arrays
+
+    def flush(self):
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, []
+        self._write(self._columns(rows))
+
+    def _write(self, arrays):
+        if self.parquet:
+            self._write_parquet(arrays)
+        else:
+            self._write_root(arrays)
+        self.nevents += len(next(iter(arrays.values())))
+
+    def _write_root(self, arrays):
+        if self._tree is None:
+            self._file = uproot.recreate(self.filepath)
+            branch_types = {name : (values.type.content if isinstance(values, ak.Array) else values.dtype)
+                            for name, values in arrays.items()}
+            self._tree = self._file.mktree(self.treename, branch_types, counter_name=lambda counted: 'njets')
+        self._tree.extend(arrays)
+
+    def _write_parquet(self, arrays):
+        # Optional dependency, only needed for Parquet output
+        import pyarrow.parquet as pq
+        table = ak.to_arrow_table(ak.zip(arrays, depth_limit=1))
+        if self._file is None:
+            self._file = pq.ParquetWriter(self.filepath, table.schema)
+        self._file.write_table(table)
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._tree = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()